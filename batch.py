@@ -0,0 +1,151 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+import colorcode
+import imagefile
+import steganography
+
+###################
+#### FILE LIST ####
+###################
+
+# an input can be
+# - a directory, in which case every file directly inside it is taken, in sorted order
+# - a manifest file, given as @FILE, with one input per line
+#   for steg-encode, a line can also give a message file after a tab
+# - a glob pattern, or just a file name
+# each job is a pair (input, message file or None)
+def getJobs(inputs, message=None):
+    jobs = []
+    for arg in inputs:
+        if arg.startswith('@'):
+            with open(arg[1:]) as manifest:
+                for line in manifest:
+                    line = line.rstrip('\n')
+                    if not line.strip():
+                        continue
+                    fileName, _, messageFile = line.partition('\t')
+                    jobs.append((fileName, messageFile or message))
+        elif os.path.isdir(arg):
+            for fileName in sorted(os.listdir(arg)):
+                path = os.path.join(arg, fileName)
+                if os.path.isfile(path):
+                    jobs.append((path, message))
+        else:
+            matches = sorted(glob.glob(arg)) or [arg]
+            jobs.extend((path, message) for path in matches)
+    return jobs
+
+# output file name for an input file: same base name in the output directory
+# (or next to the input), with a prefix and optionally a new extension
+def outputName(fileName, outputDir, prefix='', extension=None):
+    directory, base = os.path.split(fileName)
+    if extension is not None:
+        base = os.path.splitext(base)[0] + extension
+    return os.path.join(outputDir if outputDir is not None else directory, prefix + base)
+
+##############
+#### JOBS ####
+##############
+
+# each job runs in a worker process and returns a dictionary of results
+# these are top level functions so that they can be sent to the worker processes
+
+def colorcodeEncode(fileName, messageFile, options):
+    OUTPUT = outputName(fileName, options['OUTPUTDIR'], extension='.png')
+    with open(fileName) as inFile:
+        image = colorcode.ColorCode(inFile.read(), options['BLOCK'], options['NCOLS'], options['NROWS'])
+    image.write(OUTPUT)
+    return {'output': OUTPUT, 'ncols': image.sizeX, 'nrows': image.sizeY}
+
+def colorcodeDecode(fileName, messageFile, options):
+    image = imagefile.openImage(fileName, mapped=True)
+    return {'message': colorcode.decode(image, options['NCOLS'], options['NROWS'])}
+
+def stegEncode(fileName, messageFile, options):
+    if messageFile is None:
+        raise Exception('No message file specified')
+    OUTPUT = outputName(fileName, options['OUTPUTDIR'], prefix='steg_')
+    with open(messageFile) as inFile:
+        coder = steganography.SteganographyCode(imagefile.openImage(fileName), inFile.read())
+    coder.write(OUTPUT)
+    return {'output': OUTPUT}
+
+def stegDecode(fileName, messageFile, options):
+    image = imagefile.openImage(fileName, mapped=True)
+    return {'message': steganography.extract(image, options['LENGTH'])}
+
+MODES = {
+    'encode'     : colorcodeEncode,
+    'decode'     : colorcodeDecode,
+    'steg-encode': stegEncode,
+    'steg-decode': stegDecode,
+}
+
+# run one job, timing it and catching any error
+# so that one bad file doesn't abort the whole batch
+def runJob(mode, fileName, messageFile, options):
+    result = {'input': fileName}
+    start = time.perf_counter()
+    try:
+        result.update(MODES[mode](fileName, messageFile, options))
+        result['ok'] = True
+    except Exception as error:
+        result['ok'] = False
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['seconds'] = round(time.perf_counter() - start, 6)
+    return result
+
+# run all of the jobs in a process pool
+# and yield the results as soon as they are done, in any order
+def runBatch(mode, jobs, options, workers=None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runJob, mode, fileName, messageFile, options) for fileName, messageFile in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+###############################
+#### MAIN ARGPARSE AND RUN ####
+###############################
+
+# - provide a mode: encode or decode (colorcode.py), steg-encode or steg-decode (steganography.py)
+# - provide any number of directories, glob patterns, or @manifest files
+# - the other options are the same as for the single-file scripts, and apply to every file
+# results are written to stdout as JSON lines, one per file, as soon as each is done
+# a summary is written to stderr at the end
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('MODE'                                                        , choices=sorted(MODES), help='what to do with each file'                      )
+    parser.add_argument('INPUTS'                                                      , nargs='+'            , help='directories, glob patterns, or @manifest files')
+    parser.add_argument('-od', '--outputdir' , dest='OUTPUTDIR', default=None       ,                          help='output directory (default: next to the input)' )
+    parser.add_argument('-m' , '--message'   , dest='MESSAGE'  , default=None       ,                          help='message file for steg-encode'                   )
+    parser.add_argument('-nr', '--nrows'     , dest='NROWS'    , default=None       , type=int,                help='number of rows'                                 )
+    parser.add_argument('-nc', '--ncols'     , dest='NCOLS'    , default=None       , type=int,                help='number of columns'                              )
+    parser.add_argument('-b' , '--blocksize' , dest='BLOCK'    , default=[1, 1]     , type=int, nargs=2      , help='block size X Y to scale up'                     )
+    parser.add_argument('-l' , '--length'    , dest='LENGTH'   , default=None       , type=int,                help='number of characters to decode'                 )
+    parser.add_argument('-j' , '--jobs'      , dest='JOBS'     , default=None       , type=int,                help='number of worker processes'                     )
+    args = parser.parse_args(argv)
+
+    if args.OUTPUTDIR is not None:
+        os.makedirs(args.OUTPUTDIR, exist_ok=True)
+
+    jobs = getJobs(args.INPUTS, args.MESSAGE)
+    options = vars(args)
+
+    nFailed = 0
+    start = time.perf_counter()
+    for result in runBatch(args.MODE, jobs, options, args.JOBS):
+        nFailed += not result['ok']
+        print(json.dumps(result), flush=True)
+
+    print('{} files, {} failed, {:.3f} s'.format(len(jobs), nFailed, time.perf_counter() - start), file=sys.stderr)
+    return 1 if nFailed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+from PIL import Image
+
+import colorcode
+import imagefile
+import steganography
+
+########################
+#### PRETTY PRINTER ####
+########################
+def colorize(arg, color=None, end=True):
+    colorCodes = {
+        None   : '',
+        'bold' : 1,
+        'red'  : 31,
+        'green': 32,
+        'blue' : 34,
+        'pink' : 35,
+        'cyan' : 36,
+    }
+    CODE = colorCodes[color]
+    return '\033[{}m{}{}'.format(CODE, arg, '' if not end else '\033[m')
+
+def bold(arg):
+    return colorize(arg, 'bold')
+
+##########################
+#### SYNTHETIC INPUTS ####
+##########################
+
+# messages are built from a base of at most this many random characters, repeated
+# so that even 100 MB messages are quick to make
+BASESIZE = 2**16
+
+# a reproducible ASCII message of the given length that looks roughly like text:
+# printable characters with a space every so often and a newline every so often
+def makeMessage(nChars, seed=0):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + string.punctuation + ' ' * 10 + '\n'
+    base = ''.join(rng.choice(alphabet) for i in range(min(nChars, BASESIZE)))
+    return (base * math.ceil(nChars / max(len(base), 1)))[:nChars]
+
+# a reproducible cover image of random noise with about the given number of megapixels
+# as close to 4:3 as possible
+def makeCover(megapixels, seed=0):
+    nPixels = max(1, int(megapixels * 10**6))
+    width = max(1, round(math.sqrt(nPixels * 4 / 3)))
+    height = max(1, nPixels // width)
+    nBytes = width * height * 3
+    rng = random.Random(seed)
+    base = bytes(rng.getrandbits(8) for i in range(min(nBytes, BASESIZE)))
+    return Image.frombytes('RGB', (width, height), (base * math.ceil(nBytes / len(base)))[:nBytes])
+
+# parse a size such as 1000, 1K, 2.5M, or 1G (powers of 1000)
+def parseSize(arg):
+    units = {'K': 10**3, 'M': 10**6, 'G': 10**9}
+    if arg[-1:].upper() in units:
+        return int(float(arg[:-1]) * units[arg[-1:].upper()])
+    return int(arg)
+
+# parse a block size such as 4 (4 x 4) or 4x2
+def parseBlock(arg):
+    sizes = [int(size) for size in arg.lower().split('x')]
+    return sizes * 2 if len(sizes) == 1 else sizes
+
+##########################
+#### BENCHMARK STAGES ####
+##########################
+
+# start the peak resident memory of this process over from the current one, so that each stage gets
+# its own peak, and return whether that worked: it needs Linux, where writing 5 to clear_refs resets it
+# (elsewhere, the peak can only go up, so it would be the peak of every stage so far, and isn't reported)
+def resetPeakRSS():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clearFile:
+            clearFile.write('5')
+    except OSError:
+        return False
+    return True
+
+# peak resident memory of this process since resetPeakRSS, in MB, or None
+def peakRSS():
+    try:
+        with open('/proc/self/status') as statusFile:
+            for line in statusFile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024 / 10**6
+    except OSError:
+        pass
+    return None
+
+# time a function call, returning its result and the wall time in seconds
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+# run one stage of a case repeat times, adding its best time, throughput, and peak memory to stages
+# throughput is message megabytes and image megapixels per second
+# the peak memory is the highest RSS during the stage's repeats (including what earlier stages left in memory),
+# or None where it can't be reset for each stage
+def runStage(stages, name, repeat, nBytes, nPixels, function, *args, **kwargs):
+    reset = resetPeakRSS()
+    for i in range(repeat):
+        result, seconds = timed(function, *args, **kwargs)
+        seconds = min(seconds, stages[name]['seconds']) if name in stages else seconds
+        stages[name] = {
+            'seconds': seconds,
+            'MBps'   : nBytes / 10**6 / seconds if seconds else None,
+            'Mpxps'  : nPixels / 10**6 / seconds if seconds else None,
+            'rss'    : None,
+        }
+    if reset:
+        stages[name]['rss'] = peakRSS()
+    return result
+
+# output formats to try: a file extension and options for imagefile.saveImage
+OUTPUTS = {
+    'png'        : ('.png', {}),
+    'png-fast'   : ('.png', {'compressLevel': 1}),
+    'png-small'  : ('.png', {'compressLevel': 9, 'optimize': True}),
+    'png-palette': ('.png', {'palette': True}),
+    'ppm'        : ('.ppm', {}),
+    'bmp'        : ('.bmp', {}),
+    'npy'        : ('.npy', {}),
+}
+
+# save an image to a file in one of the OUTPUTS, and open it again as the decoders do
+# (uncompressed files are memory mapped, so their pixels are only read when decoding)
+def saveFile(image, fileName, output):
+    imagefile.saveImage(image, fileName, **OUTPUTS[output][1])
+    return os.path.getsize(fileName)
+
+def loadFile(fileName):
+    image = imagefile.openImage(fileName, mapped=True)
+    image.load()
+    return image
+
+# number of columns for a ColorCode with the given message length and shape (width / height in cells)
+# a shape of 1 is left to the automatic square dimensions
+def getNCols(nChars, shape):
+    if shape == 1:
+        return None
+    nCells = math.ceil((nChars + colorcode.ColorCode.HEADERLEN) / colorcode.ColorCode.RGBLEN)
+    return max(1, round(math.sqrt(nCells * shape)))
+
+# encode the message, save it to a temporary file, load it, and decode it again
+def runColorCode(case, repeat=1):
+    message = makeMessage(case['chars'])
+    ncols = getNCols(case['chars'], case['shape'])
+
+    # every repeat encodes with a new coder, since a coder keeps the image it made
+    def encode():
+        return colorcode.ColorCode(message, case['block'], ncols, dense=case['mode'] == 'dense', jobs=case['jobs']).toImage()
+
+    stages = {}
+    coder = colorcode.ColorCode(message, case['block'], ncols, dense=case['mode'] == 'dense', jobs=case['jobs'])
+    nPixels = coder.sizeX * coder.blockX * coder.sizeY * coder.blockY
+
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'image' + OUTPUTS[case['output']][0])
+        image  = runStage(stages, 'encode', repeat, len(message), nPixels, encode)
+        size   = runStage(stages, 'save'  , repeat, len(message), nPixels, saveFile, image, fileName, case['output'])
+        image  = runStage(stages, 'load'  , repeat, len(message), nPixels, loadFile, fileName)
+        result = runStage(stages, 'decode', repeat, len(message), nPixels, colorcode.decode, image, jobs=case['jobs'])
+        image.close()
+    if result != message:
+        raise Exception('Decoded message does not match')
+
+    return {'pixels': nPixels, 'bytes': size, 'stages': stages}
+
+# embed the message in a cover, save it to a temporary file, load it, and extract it again
+# a message that doesn't fit is skipped
+def runSteganography(case, repeat=1):
+    cover = makeCover(case['megapixels'])
+    nPixels = cover.size[0] * cover.size[1]
+    coder = steganography.SteganographyCode(cover, makeMessage(case['chars']), depth=case['depth'], jobs=case['jobs'])
+    if len(coder.message) > coder.capacity():
+        return {'pixels': nPixels, 'skipped': 'message does not fit'}
+
+    # every repeat embeds with a new coder, since a coder keeps the image it made
+    def embed():
+        return steganography.SteganographyCode(cover, coder.message, depth=case['depth'], jobs=case['jobs']).toImage()
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'image' + OUTPUTS[case['output']][0])
+        image  = runStage(stages, 'embed'  , repeat, len(coder.message), nPixels, embed)
+        size   = runStage(stages, 'save'   , repeat, len(coder.message), nPixels, saveFile, image, fileName, case['output'])
+        image  = runStage(stages, 'load'   , repeat, len(coder.message), nPixels, loadFile, fileName)
+        result = runStage(stages, 'extract', repeat, len(coder.message), nPixels, steganography.extract, image, jobs=case['jobs'])
+        image.close()
+    if result != coder.message:
+        raise Exception('Decoded message does not match')
+
+    return {'pixels': nPixels, 'bytes': size, 'stages': stages}
+
+CODECS = {
+    'colorcode'    : runColorCode,
+    'steganography': runSteganography,
+}
+
+# run one case
+# this is a top level function so that it can be sent to a worker process
+def runCase(case, repeat=1):
+    return CODECS[case['codec']](case, repeat)
+
+# every combination of the options, as a list of cases
+# (a palette is pointless for the noise of a cover image, so it is only tried for colorcode.py)
+def getCases(args):
+    cases = []
+    for nChars in args.NCHARS:
+        for output in args.OUTPUTS:
+            if 'colorcode' in args.CODECS:
+                for mode in args.MODES:
+                    for block in args.BLOCKS:
+                        for shape in args.SHAPES:
+                            for jobs in args.JOBS:
+                                cases.append({'codec': 'colorcode', 'mode': mode, 'chars': nChars, 'block': block, 'shape': shape, 'output': output, 'jobs': jobs})
+            if 'steganography' in args.CODECS and not OUTPUTS[output][1].get('palette'):
+                for depth in args.DEPTHS:
+                    for megapixels in args.MEGAPIXELS:
+                        for jobs in args.JOBS:
+                            cases.append({'codec': 'steganography', 'depth': depth, 'chars': nChars, 'megapixels': megapixels, 'output': output, 'jobs': jobs})
+    return cases
+
+# run every case in a fresh process, one at a time
+# so that the peak memory of each is its own, and cases don't compete for the CPU
+def runCases(cases, repeat=1):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for case in cases:
+            yield dict(case, **pool.apply(runCase, (case, repeat)))
+
+#################
+#### REPORTS ####
+#################
+
+# a short description of a case, without its codec
+def describe(case):
+    if case['codec'] == 'colorcode':
+        return '{} {}x{} shape {} {} j{}'.format(case['mode'], case['block'][0], case['block'][1], case['shape'], case.get('output', 'png'), case.get('jobs', 1))
+    return 'depth {} {} MP {} j{}'.format(case['depth'], case['megapixels'], case.get('output', 'png'), case.get('jobs', 1))
+
+# a key identifying a case, to match cases between two runs
+# (runs from before there was a choice of output were all PNG, and before there was a choice of jobs, all 1 thread)
+def caseKey(case):
+    key = {key: case[key] for key in ('codec', 'mode', 'chars', 'block', 'shape', 'depth', 'megapixels', 'output', 'jobs') if key in case}
+    key.setdefault('output', 'png')
+    key.setdefault('jobs', 1)
+    return json.dumps(key, sort_keys=True)
+
+# format a number that may be None
+def formatNumber(value):
+    return '{:9.2f}'.format(value) if value is not None else '{:>9}'.format('-')
+
+HEADER = '{:>13} {:>36} {:>10} {:>10} {:>8} {:>10} {:>9} {:>9} {:>9}'
+ROW    = '{:>13} {:>36} {:>10} {:>10} {:>8} {:>10} {} {} {}'
+
+# print the results of one case, one line per stage
+def printResult(result):
+    if 'skipped' in result:
+        print(ROW.format(result['codec'], describe(result), result['chars'], result['pixels'], '-', '-', '', '', colorize(result['skipped'], 'cyan')))
+        return
+    for name, stage in result['stages'].items():
+        print(ROW.format(
+            result['codec'], describe(result), result['chars'], result['pixels'], name,
+            '{:.4f}'.format(stage['seconds']),
+            formatNumber(stage['MBps']),
+            formatNumber(stage['Mpxps']),
+            formatNumber(stage['rss']),
+        ))
+
+# differences in time smaller than this many seconds are treated as noise
+NOISE = 0.001
+
+# compare two saved runs, stage by stage
+# a stage that is more than threshold (a fraction) slower is a regression, and more than threshold faster an improvement
+# unless the difference is within NOISE
+# return the number of regressions
+def compare(oldFile, newFile, threshold):
+    with open(oldFile) as inFile:
+        old = {caseKey(result): result for result in json.load(inFile)['results']}
+    with open(newFile) as inFile:
+        new = json.load(inFile)['results']
+
+    print(bold('{:>13} {:>30} {:>10} {:>8} {:>10} {:>10} {:>8}'.format('codec', 'case', 'chars', 'stage', 'old s', 'new s', 'change')))
+    nRegressions = 0
+    for result in new:
+        before = old.get(caseKey(result))
+        if before is None or 'stages' not in before or 'stages' not in result:
+            continue
+        for name, stage in result['stages'].items():
+            if name not in before['stages']:
+                continue
+            oldSeconds, newSeconds = before['stages'][name]['seconds'], stage['seconds']
+            change = newSeconds / oldSeconds - 1 if oldSeconds else 0
+            status = ''
+            if abs(newSeconds - oldSeconds) < NOISE:
+                pass
+            elif change > threshold:
+                status = colorize('REGRESSION', 'red')
+                nRegressions += 1
+            elif change < -threshold:
+                status = colorize('faster', 'green')
+            print('{:>13} {:>30} {:>10} {:>8} {:>10.4f} {:>10.4f} {:>+7.1%} {}'.format(
+                result['codec'], describe(result), result['chars'], name, oldSeconds, newSeconds, change, status
+            ))
+
+    print('{} regressions (threshold {:.0%})'.format(bold(nRegressions), threshold))
+    return nRegressions
+
+###############################
+#### MAIN ARGPARSE AND RUN ####
+###############################
+
+# sweep message sizes, and for colorcode.py, the mode, block sizes, and grid shapes,
+# and for steganography.py, the depth and cover image sizes, and for both, the number of threads
+# every case is encoded, saved to a temporary file in each of the output formats, loaded, and decoded, each in its own process
+# for each stage, print the time, throughput, and peak memory so far, and save all of the results as JSON
+# with --compare OLD NEW, compare two saved runs instead, and flag any stage that got slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('-c' , '--codecs'    , dest='CODECS'    , default=sorted(CODECS)          , nargs='+', choices=sorted(CODECS), help='codecs to benchmark'           )
+    parser.add_argument('-n' , '--nchars'    , dest='NCHARS'    , default=[10**3, 10**5, 10**6]   , nargs='+', type=parseSize, help='message lengths, e.g. 1K 100M'           )
+    parser.add_argument('-b' , '--blocksize' , dest='BLOCKS'    , default=[[1, 1]]                , nargs='+', type=parseBlock, help='block sizes, e.g. 1 4x2'                 )
+    parser.add_argument(       '--shapes'    , dest='SHAPES'    , default=[1.0]                   , nargs='+', type=float, help='grid width / height ratios'              )
+    parser.add_argument(       '--modes'     , dest='MODES'     , default=['ord', 'dense']        , nargs='+', choices=['ord', 'dense'], help='colorcode modes'         )
+    parser.add_argument('-mp', '--megapixels', dest='MEGAPIXELS', default=[0.1, 1.0, 5.0]         , nargs='+', type=float, help='cover image sizes in megapixels'         )
+    parser.add_argument('-f' , '--outputs'   , dest='OUTPUTS'   , default=['png']                 , nargs='+', choices=list(OUTPUTS), help='output formats to save as'       )
+    parser.add_argument('-k' , '--depth'     , dest='DEPTHS'    , default=[1]                     , nargs='+', type=int  , help='steganography bits per channel'          )
+    parser.add_argument('-j' , '--jobs'      , dest='JOBS'      , default=[1]                     , nargs='+', type=int  , help='numbers of threads, e.g. 1 2 4 (0 for all CPUs)')
+    parser.add_argument('-r' , '--repeat'    , dest='REPEAT'    , default=3                       ,            type=int  , help='times to run each stage, keeping the best')
+    parser.add_argument('-o' , '--output'    , dest='OUTPUT'    , default='benchmark.json'        ,                        help='file to save the results to'             )
+    parser.add_argument(       '--compare'   , dest='COMPARE'   , default=None                    , nargs=2  ,             help='compare two saved runs OLD NEW'          )
+    parser.add_argument(       '--threshold' , dest='THRESHOLD' , default=0.1                     ,            type=float, help='slowdown that counts as a regression'    )
+    args = parser.parse_args(argv)
+
+    if args.COMPARE is not None:
+        return 1 if compare(*args.COMPARE, args.THRESHOLD) else 0
+
+    print(bold(HEADER.format('codec', 'case', 'chars', 'pixels', 'stage', 'seconds', 'MB/s', 'Mpx/s', 'RSS MB')))
+    results = []
+    for result in runCases(getCases(args), args.REPEAT):
+        printResult(result)
+        results.append(result)
+
+    with open(args.OUTPUT, 'w') as outFile:
+        json.dump({
+            'time'    : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python'  : platform.python_version(),
+            'platform': platform.platform(),
+            'numpy'   : colorcode.np is not None,
+            'cpus'    : os.cpu_count(),
+            'repeat'  : args.REPEAT,
+            'results' : results,
+        }, outFile, indent=1)
+    print('Results saved to {}'.format(bold(args.OUTPUT)))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# a content-addressed cache of encoded images, so that the same message with the same options
+# is only encoded and compressed once, however many times it is asked for
+# the key is a hash of the message and of every option that changes the bytes of the file
+# there are two layers: an LRU dict in memory, for library callers making the same images over and over,
+# and a directory on disk, shared by every process, with one file per key
+# files on disk are written to a temporary file and renamed into place, so other processes never see
+# half of one, and once the directory is over its size, the least recently used files are removed
+# the modification time of a file is its last use, so every process agrees on the order
+
+# change to invalidate every cached image, e.g. if the encoding changes
+VERSION = 1
+
+# default directory, size on disk, and size in memory, in bytes
+CACHEDIR   = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'colorcode')
+MAXSIZE    = 2**28
+MEMORYSIZE = 2**26
+
+# prefix of temporary files, which are not cache entries
+# ones older than STALETIME seconds were left by a process that died while writing, and are removed
+TEMPPREFIX = '.tmp'
+STALETIME  = 3600
+
+# the key for a message (str or bytes) and its options, as a hex string
+# options must be JSON serializable, and their order doesn't matter
+def makeKey(message, **options):
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    digest = hashlib.sha256(json.dumps(dict(options, version=VERSION), sort_keys=True).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(message)
+    return digest.hexdigest()
+
+######################
+#### MEMORY CACHE ####
+######################
+
+# an LRU dict of keys to bytes, holding at most maxSize bytes
+# the lock makes it safe to share between threads
+class MemoryCache():
+
+    def __init__(self, maxSize=MEMORYSIZE):
+        self.maxSize = maxSize
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    # the bytes for a key, or None, which then count as the most recently used
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    # store the bytes for a key, and return the number of items evicted to make room
+    # anything larger than the whole cache isn't stored at all
+    def put(self, key, data):
+        if len(data) > self.maxSize:
+            return 0
+        nEvicted = 0
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.maxSize:
+                self.size -= len(self.items.popitem(last=False)[1])
+                nEvicted += 1
+        return nEvicted
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+####################
+#### DISK CACHE ####
+####################
+
+# a directory of files named by their keys, holding at most about maxSize bytes
+# any number of processes can use the same directory at once: a file that another process
+# removes in the meantime is just a miss
+class DiskCache():
+
+    def __init__(self, directory=CACHEDIR, maxSize=MAXSIZE):
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key)
+
+    # the bytes for a key, or None; a hit updates the modification time, which is its last use
+    def get(self, key):
+        path = self.getPath(key)
+        try:
+            with open(path, 'rb') as inFile:
+                data = inFile.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    # write the bytes for a key atomically, then evict, and return the number of files evicted
+    # anything larger than the whole cache isn't stored at all
+    def put(self, key, data):
+        if len(data) > self.maxSize:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, prefix=TEMPPREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as outFile:
+                outFile.write(data)
+            os.replace(tempPath, self.getPath(key))
+        except:
+            try:
+                os.unlink(tempPath)
+            except OSError:
+                pass
+            raise
+        return self.evict()
+
+    # the cache entries, as (modification time, size, path), oldest first
+    # and remove stale temporary files on the way
+    def getEntries(self):
+        entries = []
+        try:
+            files = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return entries
+        now = time.time()
+        for entry in files:
+            try:
+                stat = entry.stat()
+                if not entry.name.startswith(TEMPPREFIX):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif now - stat.st_mtime > STALETIME:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        return sorted(entries)
+
+    # remove the least recently used files until the directory is at most maxSize bytes
+    # and return the number removed
+    def evict(self):
+        entries = self.getEntries()
+        size = sum(entry[1] for entry in entries)
+        nEvicted = 0
+        for mtime, entrySize, path in entries:
+            if size <= self.maxSize:
+                break
+            try:
+                os.unlink(path)
+                nEvicted += 1
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+        return nEvicted
+
+    # the number of files and bytes in the cache
+    def usage(self):
+        entries = self.getEntries()
+        return len(entries), sum(entry[1] for entry in entries)
+
+    def clear(self):
+        for mtime, size, path in self.getEntries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+#####################
+#### IMAGE CACHE ####
+#####################
+
+# the memory layer in front of the disk layer, with hit and miss statistics
+# directory None keeps the cache in memory only, and memorySize 0 keeps it on disk only
+class ImageCache():
+
+    def __init__(self, directory=CACHEDIR, maxSize=MAXSIZE, memorySize=MEMORYSIZE):
+        self.memory = MemoryCache(memorySize) if memorySize else None
+        self.disk = DiskCache(directory, maxSize) if directory is not None else None
+        self.stats = {'hits': 0, 'memory': 0, 'disk': 0, 'misses': 0, 'puts': 0, 'evicted': 0}
+
+    # the bytes for a key, or None
+    # a hit on disk is copied into memory, for next time
+    def get(self, key):
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                self.stats['hits'] += 1
+                self.stats['memory'] += 1
+                return data
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.stats['hits'] += 1
+                self.stats['disk'] += 1
+                if self.memory is not None:
+                    self.memory.put(key, data)
+                return data
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, data):
+        self.stats['puts'] += 1
+        if self.memory is not None:
+            self.stats['evicted'] += self.memory.put(key, data)
+        if self.disk is not None:
+            self.stats['evicted'] += self.disk.put(key, data)
+
+    # the bytes for a key, calling make() to make them (and storing them) on a miss
+    def fetch(self, key, make):
+        data = self.get(key)
+        if data is None:
+            data = make()
+            self.put(key, data)
+        return data
+
+    # the fraction of lookups that were hits
+    def hitRate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.
+
+    def clear(self):
+        if self.memory is not None:
+            self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+
+import compression
+
+# a thin client for daemon.py
+# it only uses the standard library and compression.py (which does too), and doesn't import Pillow
+# or the scripts, so that it starts as quickly as Python itself; the daemon does all of the work
+
+##################
+#### PROTOCOL ####
+##################
+
+# every request and response is a frame: the length of a JSON header and the length of
+# a binary body, as two 4-byte big-endian integers, then the header, then the body
+# a request header has an id, an op, and the op's arguments:
+#   encode  : message (or the body, as bytes), block, ncols, nrows, header, dense, compress
+#   decode  : ncols, nrows, detect, offset, length
+#   embed   : message, header, depth, compress
+#   extract : length
+#   ping, stats
+# an image to read is the body, or a file the daemon can read, given as input
+# an image to write is returned as the body, in format (default png), or written to a file given as output,
+# and level, optimize, and palette are as for the scripts
+# a response header has the same id, ok, and either result or error
+FRAME    = struct.Struct('>II')
+MAXFRAME = 2**30
+
+# default address: a Unix socket in the temporary directory
+SOCKET = os.path.join(tempfile.gettempdir(), 'colorcode.sock')
+HOST   = '127.0.0.1'
+
+def makeFrame(header, body=b''):
+    header = json.dumps(header).encode('utf-8')
+    return FRAME.pack(len(header), len(body)) + header + body
+
+# check the lengths of a frame before reading it
+def checkFrame(prefix):
+    headerLength, bodyLength = FRAME.unpack(prefix)
+    if headerLength + bodyLength > MAXFRAME:
+        raise Exception('Frame of {} bytes is too large'.format(headerLength + bodyLength))
+    return headerLength, bodyLength
+
+################
+#### CLIENT ####
+################
+
+class Client():
+
+    # connect to the daemon on a Unix socket at path, or on TCP at host and port if port is given
+    def __init__(self, path=SOCKET, host=HOST, port=None):
+        if port is None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.socket.makefile('rb')
+        self.id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def readExactly(self, length):
+        data = self.file.read(length)
+        if len(data) < length:
+            raise Exception('Connection closed by the daemon')
+        return data
+
+    # send one request and wait for its response
+    # return the result and the body, or raise the daemon's error
+    def request(self, op, body=b'', **fields):
+        self.id += 1
+        self.socket.sendall(makeFrame(dict(fields, id=self.id, op=op), body))
+
+        headerLength, bodyLength = checkFrame(self.readExactly(FRAME.size))
+        header = json.loads(self.readExactly(headerLength).decode('utf-8'))
+        body = self.readExactly(bodyLength)
+        if not header['ok']:
+            raise Exception(header['error'])
+        return header['result'], body
+
+###############################
+#### MAIN ARGPARSE AND RUN ####
+###############################
+
+# - provide an op: encode, decode (as colorcode.py), embed, extract (as steganography.py), ping, or stats
+# - the options are the same as for the scripts
+# - image files are read and written by the daemon, so they must be where it can see them
+#   (and in its --root, if it has one); with --send, the client reads and writes them instead
+#   and sends them over the connection, which is the only way on TCP unless the daemon has a --root
+# - the message is read from a file or from standard input (-), without a prompt
+# the result is printed as JSON on stderr, and any decoded message on stdout
+
+# the path of a file for the daemon, which may have a different working directory
+def getPath(fileName):
+    return None if fileName is None else os.path.abspath(fileName)
+
+def readMessage(fileName, binary=False):
+    if fileName == '-':
+        return sys.stdin.buffer.read() if binary else sys.stdin.read()
+    with open(fileName, 'rb' if binary else 'r') as inFile:
+        return inFile.read()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('OP'                                                    , choices=('encode', 'decode', 'embed', 'extract', 'ping', 'stats'), help='what to ask the daemon to do')
+    parser.add_argument('-i' , '--input'     , dest='INPUT'   , default=None       ,                    help='input image (or message file for encode)')
+    parser.add_argument('-o' , '--output'    , dest='OUTPUT'  , default=None       ,                    help='output image'                     )
+    parser.add_argument('-m' , '--message'   , dest='MESSAGE' , default='-'        ,                    help='message file or - for stdin'      )
+    parser.add_argument('-b' , '--blocksize' , dest='BLOCK'   , default=[1, 1]     , nargs=2, type=int, help='block size X Y to scale up'       )
+    parser.add_argument('-nr', '--nrows'     , dest='NROWS'   , default=None       ,          type=int, help='number of rows'                   )
+    parser.add_argument('-nc', '--ncols'     , dest='NCOLS'   , default=None       ,          type=int, help='number of columns'                )
+    parser.add_argument('-k' , '--depth'     , dest='DEPTH'   , default=1          ,          type=int, help='number of bits per channel, 1 to 4')
+    parser.add_argument('-l' , '--length'    , dest='LENGTH'  , default=None       ,          type=int, help='number of characters to decode'   )
+    parser.add_argument(       '--offset'    , dest='OFFSET'  , default=0          ,          type=int, help='first character to decode'        )
+    parser.add_argument(       '--noheader'  , dest='HEADER'  , action='store_false',                   help='whether to leave out the header'  )
+    parser.add_argument(       '--nodetect'  , dest='DETECT'  , action='store_false',                   help='whether to assume 1 x 1 px blocks' )
+    parser.add_argument(       '--dense'     , dest='DENSE'   , action='store_true',                    help='whether to store 8 bits per channel')
+    parser.add_argument(       '--compress'  , dest='COMPRESS', default=None       , choices=compression.CODECS, help='codec to compress the message with')
+    parser.add_argument(       '--level'     , dest='LEVEL'   , default=None       , type=int, choices=range(10), help='PNG compression level, 0 to 9'   )
+    parser.add_argument(       '--optimize'  , dest='OPTIMIZE', action='store_true',                    help='whether to make the PNG as small as possible')
+    parser.add_argument(       '--palette'   , dest='PALETTE' , action='store_true',                    help='whether to save with a palette if possible')
+    parser.add_argument(       '--send'      , dest='SEND'    , action='store_true',                    help='whether to send image files over the connection')
+    parser.add_argument(       '--socket'    , dest='SOCKET'  , default=SOCKET     ,                    help='Unix socket of the daemon'        )
+    parser.add_argument(       '--host'      , dest='HOST'    , default=HOST       ,                    help='host of the daemon, with --port'  )
+    parser.add_argument(       '--port'      , dest='PORT'    , default=None       ,          type=int, help='TCP port of the daemon'           )
+    args = parser.parse_args(argv)
+
+    fields, body = {}, b''
+    if args.OP == 'encode':
+        fields.update(block=args.BLOCK, ncols=args.NCOLS, nrows=args.NROWS, header=args.HEADER, dense=args.DENSE, compress=args.COMPRESS)
+        message = readMessage(args.MESSAGE if args.INPUT is None else args.INPUT, args.DENSE or args.COMPRESS is not None)
+        if isinstance(message, bytes):
+            body = message
+        else:
+            fields['message'] = message
+    elif args.OP == 'decode':
+        fields.update(ncols=args.NCOLS, nrows=args.NROWS, detect=args.DETECT, offset=args.OFFSET, length=args.LENGTH)
+    elif args.OP == 'embed':
+        fields.update(message=readMessage(args.MESSAGE), header=args.HEADER, depth=args.DEPTH, compress=args.COMPRESS)
+    elif args.OP == 'extract':
+        fields.update(length=args.LENGTH)
+
+    if args.OP in ('decode', 'embed', 'extract'):
+        if args.INPUT is None:
+            raise Exception('No image file specified')
+        if args.SEND:
+            with open(args.INPUT, 'rb') as inFile:
+                body = inFile.read()
+        else:
+            fields['input'] = getPath(args.INPUT)
+
+    if args.OP in ('encode', 'embed'):
+        output = args.OUTPUT
+        if output is None:
+            output = 'image.png' if args.OP == 'encode' else 'steg_' + os.path.basename(args.INPUT)
+        fields.update(level=args.LEVEL, optimize=args.OPTIMIZE, palette=args.PALETTE, format=os.path.splitext(output)[1][1:] or 'png')
+        if not args.SEND:
+            fields['output'] = getPath(output)
+
+    with Client(args.SOCKET, args.HOST, args.PORT) as client:
+        result, body = client.request(args.OP, body, **fields)
+
+    if args.OP in ('encode', 'embed'):
+        if args.SEND:
+            with open(output, 'wb') as outFile:
+                outFile.write(body)
+        result['output'] = output
+
+    message = result.pop('message', None)
+    print(json.dumps(result), file=sys.stderr)
+    if message is not None:
+        print(message)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,21 @@
 import argparse
+import codecs
+import io
 import math
+import os
 from PIL import Image
-import itertools
+
+import cache
+import compression
+import imagefile
+import parallel
+import profiling
+
+# NumPy is optional; without it, the pure Python paths are used
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ########################
 #### PRETTY PRINTER ####
@@ -32,30 +46,131 @@ class ColorCode():
     NULL   = chr(0)
     RGBLEN = 3
 
+    # header, stored in the first cells as if it were the first characters of the message
+    # every value is 7 bits (0-127) so that it is stored exactly like a character
+    # cell 0: MAGIC[0], blockX, blockY (0 if 128 or more)
+    # cell 1: MAGIC[1], MAGIC[2], VERSION
+    # cell 2: flags, then the message length in 5 base 128 digits, most significant first
+    # since cell 0 is always at the top left pixel, the decoder can read it without knowing
+    # the block size, and the block size gives the dimensions from the image size
+    MAGIC     = (14, ord('C'), ord('C'))
+    VERSION   = 1
+    HEADERLEN = 12
+    LENDIGITS = 5
+
+    # header flags
+    # DENSE: the message is bytes, stored as they are, 8 bits per channel
+    # SEVEN: (with DENSE) the message is ASCII, so only 7 bits of each byte are stored,
+    #        packed continuously so that 8 characters take up 7 channels
+    # CODEC: (with DENSE) bits 2 and 3 are the number of the codec the message is compressed with
+    #        (see compression.py), and the length is the compressed length
+    FLAG_DENSE = 1
+    FLAG_SEVEN = 2
+    CODECSHIFT = 2
+    CODECMASK  = 0x0C
+
+    # maps every byte to 2 * byte, the bytes equivalent of charToChannel
+    DOUBLE = bytes((2 * i) % 256 for i in range(256))
+
     # encapsulate the conversion from a character to a channel
     # in this case, it is simple: 2 * the ascii value of the character
     # static function (doesn't take self)
     def charToChannel(char):
         return 2 * ord(char)
 
-    # initialize with parsed arguments
-    # args should have INPUT, BLOCK, NCOLS, NROWS, OUTPUT
-    def __init__(self, args):
-        self.args = args
+    # pack ASCII bytes into a continuous stream of 7 bit values
+    # every 8 characters become 7 bytes; the last group is padded with 0 bits
+    # groups of 8 don't depend on each other, so with NumPy, bands of them are packed in jobs threads
+    # static function (doesn't take self)
+    @profiling.profiled
+    def packSeven(data, jobs=1):
+        if np is not None:
+            def packBand(start, end):
+                bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=end-start, offset=start)).reshape(-1, 8)[:, 1:]
+                return np.packbits(bits).tobytes()
+            return b''.join(parallel.mapBands(packBand, 0, len(data), jobs, 8))
 
-        # message: read from input or from a file
-        if args.INPUT == '-':
-            self.message = input('{}: {}'.format(bold('Enter message here'), colorize('', 'blue', False)))
-            print('\033[m', end='')
+        packed = bytearray()
+        for idx in range(0, len(data), 8):
+            group = data[idx:idx+8]
+            value = 0
+            for code in group:
+                value = (value << 7) | code
+            value <<= 7 * (8 - len(group))
+            packed += value.to_bytes(7, 'big')[:math.ceil(7 * len(group) / 8)]
+        return bytes(packed)
+
+    # the inverse of packSeven, for nChars characters
+    # static function (doesn't take self)
+    @profiling.profiled
+    def unpackSeven(packed, nChars, jobs=1):
+        if np is not None:
+            def unpackBand(start, end):
+                first, last = 7*start//8, min(math.ceil(7*end/8), len(packed))
+                bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8, count=last-first, offset=first))[:7 * (end-start)].reshape(-1, 7)
+                return np.packbits(np.pad(bits, ((0, 0), (1, 0))), axis=1).tobytes()
+            return b''.join(parallel.mapBands(unpackBand, 0, nChars, jobs, 8))
+
+        data = bytearray()
+        for idx in range(0, nChars, 8):
+            group = min(8, nChars - idx)
+            value = int.from_bytes(packed[7*idx//8:7*idx//8+7].ljust(7, b'\x00'), 'big')
+            data += bytes((value >> (7 * (7 - k))) % 128 for k in range(group))
+        return bytes(data)
+
+    # make the header for a message of the given length, as a string of HEADERLEN characters
+    # static function (doesn't take self)
+    def makeHeader(length, block, flags=0):
+        blockX, blockY = [size if size < 128 else 0 for size in block]
+        digits = [(length >> (7*n)) % 128 for n in reversed(range(ColorCode.LENDIGITS))]
+        if length >> (7*ColorCode.LENDIGITS):
+            raise Exception('Message is too long')
+        values = [ColorCode.MAGIC[0], blockX, blockY, ColorCode.MAGIC[1], ColorCode.MAGIC[2], ColorCode.VERSION, flags] + digits
+        return ''.join(chr(value) for value in values)
+
+    # initialize with the message (str, or ASCII bytes)
+    # block is the block size X, Y; ncols and nrows constrain the dimensions
+    # if header is True, the message is prefixed with the header, so that it can be decoded
+    # without knowing the dimensions, and without stripping anything off the end
+    # if dense is True, the message is any bytes (or str, encoded as UTF-8) stored 8 bits per channel
+    # (or, if they are all ASCII, packed 7 bits per character)
+    # then self.message is just the header, and self.data is the packed message
+    # if compress is a codec name (see compression.py), the message is compressed first, which implies dense
+    # jobs is the number of threads to fill the image in (see parallel.py), which gives the same image
+    # no files are read or written here, see main for the command line version
+    def __init__(self, message, block=(1, 1), ncols=None, nrows=None, header=True, dense=False, compress=None, jobs=1):
+        self.jobs = jobs
+        if compress is not None:
+            if not header:
+                raise Exception('Compression requires a header')
+            dense = True
+        self.dense = dense
+        self.data  = b''
+        if dense:
+            if not header:
+                raise Exception('Dense mode requires a header')
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            flags = ColorCode.FLAG_DENSE | compression.codecNumber(compress) << ColorCode.CODECSHIFT
+            self.data = bytes(message)
+            if compress is not None:
+                with profiling.stage('compress', codec=compress):
+                    self.data = compression.compress(self.data, compress)
+            length = len(self.data)
+            if self.data.isascii():
+                flags |= ColorCode.FLAG_SEVEN
+                self.data = ColorCode.packSeven(self.data, jobs)
+            message = ColorCode.makeHeader(length, block, flags)
         else:
-            try:
-                self.message = open(args.INPUT).read()
-                print('Reading text from {}'.format(bold(args.INPUT)))
-            except:
-                raise Exception('Error reading from {}'.format(args.INPUT))
+            if isinstance(message, bytes):
+                message = message.decode('ascii')
+            if header:
+                message = ColorCode.makeHeader(len(message), block) + message
+        self.message = message
+        self.ncols, self.nrows = ncols, nrows
 
-        # number of characters in the message
-        self.nChars  = len(self.message)
+        # number of characters in the message, i.e. the number of channels it takes up
+        self.nChars  = len(self.message) + len(self.data)
 
         # number of blocks needed to encode the message
         # characters are grouped into 3s with one or two empties
@@ -65,7 +180,7 @@ class ColorCode():
         self.sizeX, self.sizeY = self.computeDimensions()
 
         # get block size
-        self.blockX, self.blockY = args.BLOCK
+        self.blockX, self.blockY = block
 
     # compute dimensions
     # with no constraints, make the dimensions square
@@ -74,17 +189,17 @@ class ColorCode():
 
         # neither NCOLS nor NROWS was specified
         # so define dimensions to be as square as possible
-        if self.args.NROWS is None and self.args.NCOLS is None:
+        if self.nrows is None and self.ncols is None:
             sizeX, sizeY = self.getAutoDimensions()
 
         # NCOLS was specified
-        elif args.NCOLS is not None:
-            sizeX = args.NCOLS
+        elif self.ncols is not None:
+            sizeX = self.ncols
             sizeY = math.ceil(self.nBlocks / sizeX)
 
         # NROWS was specified and NCOLS was not
         else:
-            sizeY = args.NROWS
+            sizeY = self.nrows
             sizeX = math.ceil(self.nBlocks / sizeY)
 
         return sizeX, sizeY
@@ -112,65 +227,403 @@ class ColorCode():
         # done now
         return sizeX, sizeY
 
-    # compute the array of colors
-    # i.e. the image as if it were 1x1 block size
-    # instead of a more pythonic grouper, just slice through 3 at a time
-    # for the very last block, it's possible that the slice is 1 or 2 characters
-    # so tack on NULL characters until it's 3 characters
+    # the value of every channel, in order
+    # the characters of the message, converted with charToChannel, and then in dense mode the data as is
+    # as bytes if possible; otherwise (non-ASCII characters) a list, since the values can be over 255
+    def getChannels(self):
+        if self.message.isascii():
+            return self.message.encode('ascii').translate(ColorCode.DOUBLE) + self.data
+        return [ColorCode.charToChannel(char) for char in self.message]
+
+    # compute the colors, i.e. the image as if it were 1x1 block size, as a bytearray of channels
+    # for the very last cell, it's possible that there are only 1 or 2 channels left
+    # so tack on NULL characters (channel 0) until it's 3 channels
     # then, it's possible that nBlocks < sizeX * sizeY
     # so tack on WHITE squares until they're all filled up
+    # channels over 255 (from non-ASCII characters) are clipped to 255, as Pillow does
+    @profiling.profiled
     def fillColors(self):
-        self.array = []
-        for idx in range(0, self.nChars, ColorCode.RGBLEN):
-            messageSlice = self.message[idx:idx+ColorCode.RGBLEN]
-            while len(messageSlice) < ColorCode.RGBLEN:
-                messageSlice += ColorCode.NULL
-            self.array.append( tuple([ColorCode.charToChannel(char) for char in messageSlice]) )
-
-        while len(self.array) < self.sizeX*self.sizeY:
-            self.array.append(ColorCode.WHITE)
-
-    # the actual image is the array, blown up by the block size
-    # Image requires a 1D array with a tuple defining the size
-    # pre-fill with a bunch of black squares
-    # now i, j tells you which array cell you're considering: i + j*sizeX converts 2D (i, j) to 1D
-    # and x, y tells you where within the block you are (they are all the same, of course)
-    # blowing it up means i --> i*blockX + x, j --> j*blockY + y, sizeX --> sizeX*blockX
+        channels = self.getChannels()
+        if not isinstance(channels, bytes):
+            channels = bytes(min(channel, 255) for channel in channels)
+        self.array = bytearray(channels)
+        self.array += bytes(self.nBlocks * ColorCode.RGBLEN - self.nChars)
+        self.array += bytes(ColorCode.WHITE) * (self.sizeX * self.sizeY - self.nBlocks)
+
+    # the actual image is the array, blown up by the block size, as a bytearray of rows of pixels
+    # every cell is repeated blockX times across (see widen), which makes a row of pixels out of
+    # each row of cells, and every row of pixels is then repeated blockY times down
+    @profiling.profiled
     def fillImage(self):
+        if self.useNumpy():
+            self.fillImageNumpy()
+            return
+
         if not hasattr(self, 'array'):
             self.fillColors()
-        self.image = [(0, 0, 0)] * (self.sizeX * self.sizeY * self.blockX * self.blockY)
+        rows = self.widen(self.array)
+        rowSize = self.sizeX * self.blockX * ColorCode.RGBLEN
+        self.image = bytearray(rowSize * self.sizeY * self.blockY)
+        for j in range(self.sizeY):
+            top = j * self.blockY * rowSize
+            self.image[top:top + self.blockY * rowSize] = rows[j*rowSize:(j+1)*rowSize] * self.blockY
+
+    # NumPy can only be used if it is installed and if the message is pure ASCII
+    # (2 * ord(char) of a non-ASCII character does not fit in a uint8)
+    def useNumpy(self):
+        return np is not None and self.message.isascii()
+
+    # vectorized version of fillColors and fillImage, producing the same pixels
+    # every row of blocks is a contiguous slice of the channels, so the image is filled in bands of rows
+    # of blocks, in jobs threads (see parallel.py)
+    # in a band, the channels are 2 * each character of the message, then the data as is,
+    # padded with NULLs up to nBlocks cells, then with WHITE up to sizeX * sizeY cells
+    # reshaping gives the colors of the band, one per block, and blowing them up means broadcasting each
+    # color over its block, straight into the image, seen as (sizeY, blockY, sizeX, blockX, 3)
+    @profiling.profiled
+    def fillImageNumpy(self):
+        message = np.frombuffer(self.message.encode('ascii'), dtype=np.uint8)
+        data = np.frombuffer(self.data, dtype=np.uint8)
+        self.image = np.empty((self.sizeY * self.blockY, self.sizeX * self.blockX, ColorCode.RGBLEN), dtype=np.uint8)
+        blocks = self.image.reshape(self.sizeY, self.blockY, self.sizeX, self.blockX, ColorCode.RGBLEN)
+        rowLength = self.sizeX * ColorCode.RGBLEN
+
+        def fillBand(top, bottom):
+            start, end = top * rowLength, bottom * rowLength
+            colors = np.full(end - start, 255, dtype=np.uint8)
+            colors[:max(self.nBlocks * ColorCode.RGBLEN - start, 0)] = 0
+            part = message[start:end]
+            colors[:part.size] = part << 1
+            offset = max(message.size - start, 0)
+            part = data[max(start - message.size, 0):max(end - message.size, 0)]
+            colors[offset:offset + part.size] = part
+            blocks[top:bottom] = colors.reshape(bottom - top, 1, self.sizeX, 1, ColorCode.RGBLEN)
+
+        parallel.mapBands(fillBand, 0, self.sizeY, self.jobs, itemSize=rowLength * self.blockX * self.blockY)
 
-        for i, j, x, y in itertools.product(range(self.sizeX), range(self.sizeY), range(self.blockX), range(self.blockY)):
-            self.image[(i*self.blockX + x) + (j*self.blockY + y)*self.sizeX*self.blockX] = self.array[i+j*self.sizeX]
+    # turn one row of cells' worth of channels into one row of pixels
+    # the chunk may be short at the end of the message:
+    # pad the last cell with NULLs, then pad the row with WHITE squares
+    # each cell is repeated blockX times to blow it up horizontally
+    def fillRow(self, channels):
+        nCells = math.ceil(len(channels) / ColorCode.RGBLEN)
+        channels += bytes(nCells * ColorCode.RGBLEN - len(channels))
+        channels += bytes(ColorCode.WHITE) * (self.sizeX - nCells)
 
-    # write to file
-    def write(self):
+        return self.widen(channels)
+
+    # repeat every cell of channels blockX times, as bytes
+    # without NumPy, each channel of each copy is a strided slice of the result, filled in one assignment
+    def widen(self, channels):
+        if self.blockX == 1:
+            return bytes(channels)
+        if np is not None:
+            cells = np.frombuffer(channels, dtype=np.uint8).reshape(-1, ColorCode.RGBLEN)
+            return np.repeat(cells, self.blockX, axis=0).tobytes()
+        wide = bytearray(len(channels) * self.blockX)
+        step = ColorCode.RGBLEN * self.blockX
+        for x in range(self.blockX):
+            for channel in range(ColorCode.RGBLEN):
+                wide[x*ColorCode.RGBLEN + channel::step] = channels[channel::ColorCode.RGBLEN]
+        return bytes(wide)
+
+    # the image as a PIL Image
+    def toImage(self):
         if not hasattr(self, 'image'):
             self.fillImage()
 
-        imFile = Image.new('RGB', (self.sizeX*self.blockX, self.sizeY*self.blockY))
-        imFile.putdata(self.image)
+        if np is not None and isinstance(self.image, np.ndarray):
+            with profiling.stage('fromarray'):
+                return Image.fromarray(self.image)
+
+        with profiling.stage('frombytes'):
+            return Image.frombytes('RGB', (self.sizeX*self.blockX, self.sizeY*self.blockY), self.image)
+
+    # write to file, in the format given by the extension (see imagefile.py)
+    # compressLevel and optimize control PNG compression, and palette saves a palette image if possible
+    # return the image as it was saved
+    def write(self, fileName, compressLevel=None, optimize=False, palette=False):
+        imFile = self.toImage()
         try:
-            imFile.save(self.args.OUTPUT)
+            with profiling.stage('save'):
+                return imagefile.saveImage(imFile, fileName, compressLevel, optimize, palette)
         except:
-            raise Exception('Error when trying to write to {}'.format(bold(self.args.OUTPUT)))
-
-        print('{} created: {} x {} px, {} x {} colors'.format(
-            bold(self.args.OUTPUT),
-            self.sizeX*self.blockX,
-            self.sizeY*self.blockY,
-            self.sizeX,
-            self.sizeY,
-        ))
-        print('Decode {} with : {}'.format(
-            bold(self.args.OUTPUT),
-            colorize('python colorcode.py --decode --inputfile {} --ncols {} --nrows {}'.format(
-                self.args.OUTPUT,
-                self.sizeX,
-                self.sizeY
-            ), 'pink')
-        ))
+            raise Exception('Error when trying to write to {}'.format(bold(fileName)))
+
+###################################
+#### STREAMING COLORCODE CLASS ####
+###################################
+
+class StreamColorCode(ColorCode):
+
+    # initialize with an input file name, and otherwise like ColorCode
+    # but don't read the message: the number of characters is just the file size
+    # so the dimensions can be computed up front
+    # (for the same reason, dense mode always stores 8 bits per channel, since it isn't known
+    # whether the file is ASCII until it has all been read)
+    # to compress, the file is compressed into a temporary file first, to know the compressed size,
+    # and the message is then read from that
+    def __init__(self, fileName, block=(1, 1), ncols=None, nrows=None, header=True, dense=False, compress=None):
+        if compress is not None:
+            if not header:
+                raise Exception('Compression requires a header')
+            dense = True
+        if dense and not header:
+            raise Exception('Dense mode requires a header')
+        self.fileName = fileName
+        self.dense = dense
+        self.ncols, self.nrows = ncols, nrows
+
+        self.source = None
+        try:
+            if compress is not None:
+                with profiling.stage('compress', codec=compress):
+                    self.source, self.nChars = compression.compressFile(fileName, compress)
+            else:
+                self.nChars = os.stat(fileName).st_size
+        except OSError:
+            raise Exception('Error reading from {}'.format(fileName))
+
+        # the header, already converted to channels
+        self.header = b''
+        if header:
+            flags = ColorCode.FLAG_DENSE | compression.codecNumber(compress) << ColorCode.CODECSHIFT if dense else 0
+            self.header = ColorCode.makeHeader(self.nChars, block, flags).encode('ascii').translate(ColorCode.DOUBLE)
+            self.nChars += ColorCode.HEADERLEN
+
+        self.nBlocks = math.ceil(self.nChars / ColorCode.RGBLEN)
+        self.sizeX, self.sizeY = self.computeDimensions()
+        self.blockX, self.blockY = block
+
+    # convert message bytes read from the file to channels
+    def toChannels(self, chunk):
+        if self.dense:
+            return chunk
+        if not chunk.isascii():
+            raise Exception('Streaming mode requires an ASCII input file')
+        return chunk.translate(ColorCode.DOUBLE)
+
+    # read the message one row of cells at a time, after the header
+    # and write each row of pixels blockY times, as PNG, PPM, BMP, or NPY (see imagefile.py)
+    # only one row of pixels is ever held in memory, so a palette can't be made, and the PNG can't be optimized
+    # the image is written to a temporary file (see imagefile.tempImage) that then replaces fileName, so that an error partway through
+    # (e.g. a non-ASCII byte) doesn't leave a valid-looking image holding only part of the message
+    @profiling.profiled
+    def write(self, fileName, compressLevel=None, optimize=False, palette=False):
+        rowLength = self.sizeX * ColorCode.RGBLEN
+        if palette:
+            raise Exception('Streaming mode cannot write a palette image')
+
+        try:
+            tempName = imagefile.tempImage(fileName)
+        except OSError:
+            raise Exception('Error when trying to write to {}'.format(bold(fileName)))
+        try:
+            writer = imagefile.getWriter(tempName, self.sizeX*self.blockX, self.sizeY*self.blockY, compressLevel)
+        except OSError:
+            imagefile.removeTemp(tempName)
+            raise Exception('Error when trying to write to {}'.format(bold(fileName)))
+
+        pending = self.header
+        inFile = self.source if self.source is not None else open(self.fileName, 'rb')
+        try:
+            with inFile, writer:
+                for j in range(self.sizeY):
+                    chunk, pending = pending[:rowLength], pending[rowLength:]
+                    row = self.fillRow(chunk + self.toChannels(inFile.read(rowLength - len(chunk))))
+                    for y in range(self.blockY):
+                        writer.writeRow(row)
+        except:
+            imagefile.removeTemp(tempName)
+            raise
+        os.replace(tempName, fileName)
+
+####################################
+#### APPENDING COLORCODE CLASS ####
+####################################
+
+class AppendColorCode(ColorCode):
+
+    # initialize with the file name of an existing image with a header, and the message to add to it
+    # (str, or ASCII bytes; any bytes in dense mode)
+    # the header gives the block size, the number of columns (which stays fixed; ncols, if given, must match),
+    # the mode, and the length; the rest of the old message is never read, except the last partial row
+    # the new channels fill the padding cells after the old message first, and then new rows
+    # when packed 7 bits per character, the last partial group of 8 characters is unpacked and packed
+    # again with the new ones, which have to be ASCII too; compressed images can't be appended to
+    # the image is the same as encoding the whole message at once with ncols fixed
+    def __init__(self, fileName, message, ncols=None, jobs=1):
+        self.fileName = fileName
+        self.jobs = jobs
+        try:
+            decoder = Decode(imagefile.openImage(fileName, mapped=True))
+        except OSError:
+            raise Exception('Error when trying to open image file {}'.format(bold(fileName)))
+
+        if not decoder.hasHeader:
+            raise Exception('Appending requires an image with a header')
+        if decoder.getCodec() is not None:
+            raise Exception('Compressed images cannot be appended to')
+        if ncols is not None and ncols != decoder.sizeX:
+            raise Exception('Image has {} columns, not {}'.format(decoder.sizeX, ncols))
+        self.dense = decoder.isDense()
+        self.sizeX, self.oldSizeY = decoder.sizeX, decoder.sizeY
+        self.blockX, self.blockY = decoder.blockX, decoder.blockY
+
+        # the new channels, which replace everything from channel start on
+        if not self.dense:
+            if isinstance(message, bytes):
+                message = message.decode('ascii')
+            if not message.isascii():
+                raise Exception('Only ASCII can be appended to an image that is not dense')
+            self.start = decoder.getNChannels()
+            self.data = message.encode('ascii').translate(ColorCode.DOUBLE)
+        else:
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            if decoder.isSeven():
+                if not message.isascii():
+                    raise Exception('Only ASCII can be appended to an image packed 7 bits per character')
+                first = decoder.length - decoder.length % 8
+                self.start = ColorCode.HEADERLEN + 7*first//8
+                tail = ColorCode.unpackSeven(b''.join(decoder.iterChannels(self.start, decoder.getNChannels())), decoder.length - first)
+                self.data = ColorCode.packSeven(tail + message, jobs)
+            else:
+                self.start = decoder.getNChannels()
+                self.data = bytes(message)
+
+        self.oldLength = decoder.length
+        self.length  = decoder.length + len(message)
+        self.header  = ColorCode.makeHeader(self.length, (self.blockX, self.blockY), decoder.flags).encode('ascii').translate(ColorCode.DOUBLE)
+        self.nChars  = self.start + len(self.data)
+        self.nBlocks = math.ceil(self.nChars / ColorCode.RGBLEN)
+        self.sizeY   = max(self.oldSizeY, math.ceil(self.nBlocks / self.sizeX))
+
+        # the old channels of the only rows that are rewritten and still hold some of the old message:
+        # the rows with the header, and the row where the new channels start
+        rowLength = self.sizeX * ColorCode.RGBLEN
+        self.headerRows = math.ceil(ColorCode.HEADERLEN / rowLength)
+        self.firstRow = self.start // rowLength
+        self.oldRows = {
+            j: b''.join(decoder.iterChannels(j*rowLength, min((j+1)*rowLength, self.start)))
+            for j in set(range(self.headerRows)) | {self.firstRow}
+        }
+        self.oldImage = decoder.image
+
+    # the rows of cells to rewrite, as (top, bottom) runs: the header rows, and the rows from firstRow on
+    def getRuns(self):
+        if self.firstRow <= self.headerRows:
+            return [(0, self.sizeY)]
+        return [(0, self.headerRows), (self.firstRow, self.sizeY)]
+
+    # the channels of row j of cells in the new image:
+    # the old channels before start, then the new ones, with the new header over the start of the image
+    def getRowChannels(self, j):
+        rowLength = self.sizeX * ColorCode.RGBLEN
+        first, last = j*rowLength, min((j+1)*rowLength, self.nChars)
+        channels = bytearray(self.oldRows.get(j, b''))
+        channels += self.data[max(first - self.start, 0):max(last - self.start, 0)]
+        if first < ColorCode.HEADERLEN:
+            channels[:ColorCode.HEADERLEN - first] = self.header[first:first + rowLength]
+        return bytes(channels)
+
+    # write the new image over the old file
+    # uncompressed files are changed in place (see imagefile.extendImage): only the rewritten rows are written,
+    # the new ones first and the header last, so that an interrupted append leaves the old message readable
+    # other files (PNG) are loaded, the rewritten rows pasted over them in a taller image, and saved again
+    # to a temporary file that then replaces the old one
+    # return whether the file was changed in place
+    @profiling.profiled
+    def write(self, compressLevel=None, optimize=False, palette=False):
+        width, height = self.sizeX*self.blockX, self.sizeY*self.blockY
+        oldImage = self.oldImage
+        if isinstance(oldImage, imagefile.MappedImage):
+            oldImage.close()
+            oldImage = None
+
+        image = imagefile.extendImage(self.fileName, height)
+        if image is not None:
+            with image:
+                for top, bottom in reversed(self.getRuns()):
+                    for j in range(top, bottom):
+                        image.putRows(j*self.blockY, self.fillRow(self.getRowChannels(j)) * self.blockY)
+                image.flush()
+            return True
+
+        with profiling.stage('load'):
+            newImage = Image.new('RGB', (width, height))
+            newImage.paste(oldImage if oldImage is not None else imagefile.openImage(self.fileName))
+        for top, bottom in self.getRuns():
+            rows = b''.join(self.fillRow(self.getRowChannels(j)) * self.blockY for j in range(top, bottom))
+            newImage.paste(Image.frombytes('RGB', (width, (bottom - top)*self.blockY), rows), (0, top*self.blockY))
+
+        tempName = None
+        try:
+            tempName = imagefile.tempImage(self.fileName)
+            with profiling.stage('save'):
+                imagefile.saveImage(newImage, tempName, compressLevel, optimize, palette)
+            os.replace(tempName, self.fileName)
+        except:
+            if tempName is not None:
+                imagefile.removeTemp(tempName)
+            raise Exception('Error when trying to write to {}'.format(bold(self.fileName)))
+        return False
+
+#####################################
+#### MULTI-FRAME COLORCODE CLASS ####
+#####################################
+
+class FrameColorCode():
+
+    # initialize with the message, as for ColorCode, split across frames of at most maxSize (width, height) px
+    # every frame is a ColorCode image with a header, holding the next part of the message, so any frame can be
+    # decoded on its own, and the frames decoded in order give back the whole message (see iterFrames)
+    # all frames have the same grid, as wide and tall as fits (or ncols and nrows, if smaller),
+    # with the last one padded with WHITE; a message that fits in one frame keeps the usual dimensions if they fit
+    # in dense mode the message is split as bytes, and a frame whose part is all ASCII is packed 7 bits per character
+    # frames are made one at a time, as they are written, so only one is ever in memory
+    def __init__(self, message, block=(1, 1), ncols=None, nrows=None, dense=False, maxSize=(4096, 4096), jobs=1):
+        if dense and isinstance(message, str):
+            message = message.encode('utf-8')
+        elif not dense and isinstance(message, bytes):
+            message = message.decode('ascii')
+        self.message, self.dense, self.jobs = message, dense, jobs
+        self.blockX, self.blockY = block
+
+        maxCols, maxRows = maxSize[0] // self.blockX, maxSize[1] // self.blockY
+        self.sizeX, self.sizeY = min(ncols or maxCols, maxCols), min(nrows or maxRows, maxRows)
+        nChannels = self.sizeX * self.sizeY * ColorCode.RGBLEN - ColorCode.HEADERLEN
+        if nChannels <= 0:
+            raise Exception('Frames of {} x {} px are too small for a header'.format(*maxSize))
+
+        # number of characters per frame: one per channel, or 8 per 7 channels if every part will be packed
+        self.frameLength = 8 * (nChannels // 7) if dense and message.isascii() else nChannels
+        self.nFrames = max(math.ceil(len(message) / self.frameLength), 1)
+        if self.nFrames == 1:
+            single = ColorCode(message, block, ncols, nrows, True, dense, jobs=jobs)
+            if single.sizeX <= maxCols and single.sizeY <= maxRows:
+                self.sizeX, self.sizeY = single.sizeX, single.sizeY
+
+    # the ColorCode of frame index, padded to the height of every frame
+    def getFrame(self, index):
+        part = self.message[index*self.frameLength:(index+1)*self.frameLength]
+        frame = ColorCode(part, (self.blockX, self.blockY), self.sizeX, None, True, self.dense, jobs=self.jobs)
+        frame.sizeY = self.sizeY
+        return frame
+
+    # write every frame, as an APNG or a multi-page TIFF (see imagefile.getFrameWriter)
+    @profiling.profiled
+    def write(self, fileName, compressLevel=None):
+        try:
+            writer = imagefile.getFrameWriter(fileName, self.sizeX*self.blockX, self.sizeY*self.blockY, self.nFrames, compressLevel)
+        except OSError:
+            raise Exception('Error when trying to write to {}'.format(bold(fileName)))
+
+        with writer:
+            for index in range(self.nFrames):
+                image = self.getFrame(index).toImage()
+                with profiling.stage('save'):
+                    writer.writeFrame(image)
 
 #######################
 #### DECODER CLASS ####
@@ -178,30 +631,154 @@ class ColorCode():
 
 class Decode():
 
-    # load the args
-    # open the image
-    # get the height and width
-    # if either or both of NCOLS and NROWS are not specified, assume block size is 1 x 1
-    # otherwise, sizeX and sizeY are given, compute blockX and blockY from that and the image size
-    def __init__(self, args):
+    # number of rows of pixels to compare at a time when detecting the block size
+    STRIPSIZE = 256
 
-        self.args = args
+    # initialize with a PIL Image (or an array, which is converted to one), or an imagefile.MappedImage,
+    # in RGB or converted to it (see imagefile.toRGB), so palette and RGBA images decode too
+    # get the height and width
+    # if both of ncols and nrows are specified, compute blockX and blockY from that and the image size
+    # otherwise, if the image has a header, it gives blockX and blockY, and sizeX and sizeY follow
+    # otherwise, if detect is True, detect blockX and blockY from the image itself, or else assume 1 x 1,
+    # except that ncols or nrows, if one is specified, gives that one
+    # (detecting can give too large a block, if every run of identical cells is an even number long,
+    # so it is off unless asked for)
+    # then read the header, if there is one
+    # jobs is the number of threads to read the message in (see parallel.py)
+    def __init__(self, image, ncols=None, nrows=None, detect=False, jobs=1):
+        self.jobs = jobs
 
-        try:
-            self.image = Image.open(args.INPUT)
-        except:
-            raise Exception('Error when trying to open image file {}'.format(bold(self.args.INPUT)))
+        if not isinstance(image, (Image.Image, imagefile.MappedImage)):
+            image = Image.fromarray(image)
+        self.image = imagefile.toRGB(image)
 
         self.width, self.height = self.image.size
 
-        if self.args.NCOLS is None or self.args.NROWS is None:
-            print('Color dimensions not specified; assuming block size = '+bold('1 x 1 px'))
-            self.sizeX , self.sizeY  = self.width, self.height
-            self.blockX, self.blockY = 1, 1
+        if ncols is not None and nrows is not None:
+            self.sizeX , self.sizeY  = ncols                     , nrows
+            self.blockX, self.blockY = int(self.width/self.sizeX), int(self.height/self.sizeY)
+
+        elif self.getHeaderBlock() is not None:
+            self.blockX, self.blockY = self.getHeaderBlock()
+            self.sizeX , self.sizeY  = self.width//self.blockX   , self.height//self.blockY
 
         else:
-            self.sizeX , self.sizeY  = self.args.NCOLS           , self.args.NROWS
-            self.blockX, self.blockY = int(self.width/self.sizeX), int(self.height/self.sizeY)
+            self.blockX, self.blockY = self.detectBlock() if detect else (1, 1)
+            if ncols is not None:
+                self.blockX = self.width//ncols
+            if nrows is not None:
+                self.blockY = self.height//nrows
+            self.sizeX , self.sizeY  = self.width//self.blockX   , self.height//self.blockY
+
+        self.readHeader()
+
+    # the values in the top left pixel
+    # return the block size if it is the first cell of a header, otherwise None
+    # a block size of 0 means it was too large to store, so it has to be found some other way
+    def getHeaderBlock(self):
+        if self.image.mode != 'RGB':
+            return None
+        magic, blockX, blockY = [code//2 for code in self.image.getpixel((0, 0))]
+        if magic != ColorCode.MAGIC[0] or blockX == 0 or blockY == 0:
+            return None
+        return blockX, blockY
+
+    # detect the block size from the image
+    # every block boundary is somewhere that adjacent columns (or rows) of pixels differ
+    # neighboring blocks can have the same color, so a run of identical columns can be several blocks wide
+    # but every run is a whole number of blocks, so the block width is the GCD of the run lengths
+    # the LSBs are ignored when comparing, since steganography.py may have changed them
+    @profiling.profiled
+    def detectBlock(self):
+        if np is not None:
+            pixels = np.asarray(self.image)
+            if pixels.ndim == 2:
+                pixels = pixels[:, :, np.newaxis]
+            colChanges, rowChanges = self.findChangesNumpy(pixels)
+        else:
+            colChanges = Decode.findChanges(self.image.transpose(Image.Transpose.TRANSPOSE))
+            rowChanges = Decode.findChanges(self.image)
+
+        return Decode.runGCD(colChanges, self.width), Decode.runGCD(rowChanges, self.height)
+
+    # GCD of the lengths of the runs between the changes, given the positions where they happen
+    # static function (doesn't take self)
+    def runGCD(changes, size):
+        edges = [0] + list(changes) + [size]
+        return math.gcd(*[end - start for start, end in zip(edges, edges[1:])])
+
+    # positions y where row y of pixels differs from row y - 1
+    # comparing whole rows of bytes at a time, so there is one Python step per row
+    # static function (doesn't take self)
+    def findChanges(image):
+        width, height = image.size
+        changes = []
+        previous = None
+        for y in range(height):
+            row = image.crop((0, y, width, y+1)).tobytes().translate(Decode.HALVE)
+            if previous is not None and row != previous:
+                changes.append(y)
+            previous = row
+        return changes
+
+    # vectorized version of findChanges, for columns and rows at once
+    # compare neighbors in strips of rows, so that the comparison arrays stay small
+    # each strip also includes the last row of the previous strip
+    def findChangesNumpy(self, pixels):
+        colChanged = np.zeros(self.width - 1, dtype=bool)
+        rowChanged = np.zeros(self.height - 1, dtype=bool)
+        for top in range(0, self.height, Decode.STRIPSIZE):
+            strip = pixels[max(top-1, 0):top+Decode.STRIPSIZE] >> 1
+            colChanged |= np.any(strip[:, 1:] != strip[:, :-1], axis=(0, 2))
+            rowChanged[max(top-1, 0):top+Decode.STRIPSIZE-1] = np.any(strip[1:] != strip[:-1], axis=(1, 2))
+        return np.flatnonzero(colChanged) + 1, np.flatnonzero(rowChanged) + 1
+
+    # read the first HEADERLEN characters, which are in the first few cells
+    # if they are a header, set hasHeader, flags, and length (the number of characters after the header)
+    @profiling.profiled
+    def readHeader(self):
+        self.hasHeader = False
+        if self.image.mode != 'RGB' or self.sizeX * self.sizeY * ColorCode.RGBLEN < ColorCode.HEADERLEN:
+            return
+
+        values = []
+        for cell in range(ColorCode.HEADERLEN // ColorCode.RGBLEN):
+            i, j = cell % self.sizeX, cell // self.sizeX
+            values.extend(code//2 for code in self.image.getpixel((i*self.blockX, j*self.blockY)))
+
+        if tuple(values[0:1] + values[3:5]) != ColorCode.MAGIC:
+            return
+        if values[5] > ColorCode.VERSION:
+            raise Exception('Image was encoded with a newer version (header version {})'.format(values[5]))
+
+        self.hasHeader = True
+        self.flags = values[6]
+        self.length = 0
+        for digit in values[7:7+ColorCode.LENDIGITS]:
+            self.length = 128*self.length + digit
+
+    # number of cells to read to get the whole message
+    def getNCells(self):
+        if self.hasHeader:
+            return min(math.ceil(self.getNChannels() / ColorCode.RGBLEN), self.sizeX * self.sizeY)
+        return self.sizeX * self.sizeY
+
+    # number of channels the header and message take up, for a given message length
+    # the message takes one channel per character, except 7 channels per 8 characters when packed
+    def getNChannels(self, length=None):
+        if length is None:
+            length = self.length
+        if self.isSeven():
+            return ColorCode.HEADERLEN + math.ceil(7 * length / 8)
+        return ColorCode.HEADERLEN + length
+
+    # cut the message out of the decoded characters
+    # with a header, it is exactly length characters after the header
+    # otherwise, strip off the NULLs, white boxes, and a final newline
+    def trim(self, message):
+        if self.hasHeader:
+            return message[ColorCode.HEADERLEN:ColorCode.HEADERLEN + self.length]
+        return message.rstrip(chr(127)+chr(0)+"\n")
 
     # encapsulate the conversion from a channel to a character
     # in this case, it is simple: channel // 2 --> ascii
@@ -209,23 +786,260 @@ class Decode():
     def channelToChar(code):
         return chr(code//2)
 
+    # whether the message is stored 8 bits per channel
+    def isDense(self):
+        return self.hasHeader and bool(self.flags & ColorCode.FLAG_DENSE)
+
+    # whether the message is ASCII packed 7 bits per character
+    def isSeven(self):
+        return self.isDense() and bool(self.flags & ColorCode.FLAG_SEVEN)
+
+    # the codec the message is compressed with, or None
+    def getCodec(self):
+        if not self.isDense():
+            return None
+        return compression.codecName((self.flags & ColorCode.CODECMASK) >> ColorCode.CODECSHIFT)
+
     # start with empty
     # get the list of color data
     # for each j (row), for each i (column),
     # the top right of the block is the usual formula for i --> image and j --> image (with x, y = 0)
     # as long as the image isn't corrupted, the top right is guaranteed to exist and is the same as the rest
     # each element is a list of three numbers, so get the characters and string them together
-    # finally, strip off the NULLs, white boxes, and a final newline
+    # only as many cells as hold the message are read
+    # finally, trim off the header, or strip off the padding
+    # in dense mode, the message is bytes, which are decoded as UTF-8
+    @profiling.profiled
     def getMessage(self):
-        print('Attempting to decode {}:\n'.format(bold(self.args.INPUT)))
-        message = ''
-        data = list(self.image.getdata())
-        for j, i in itertools.product(range(self.sizeY), range(self.sizeX)):
-            topRight = (i)*self.blockX + (j*self.blockY)*self.blockX*self.sizeX
-            message += ''.join([Decode.channelToChar(code) for code in data[topRight]])
+        if self.isDense():
+            return self.getBytes().decode('utf-8', errors='replace')
 
-        return message.rstrip(chr(127)+chr(0)+"\n")
+        if np is not None:
+            with profiling.stage('asarray'):
+                pixels = np.asarray(self.image)
+            if pixels.ndim == 3:
+                return self.getMessageNumpy(pixels)
+
+        with profiling.stage('assemble'):
+            channels = b''.join(self.iterChannels(0, self.getNCells() * len(self.image.getbands())))
+            message = channels.translate(Decode.HALVE).decode('ascii')
+
+        return self.trim(message)
+
+    # vectorized version of getMessage
+    # channel // 2 is a right shift by 1, and the result is always ASCII
+    # so the whole message is converted to a string in one go
+    def getMessageNumpy(self, pixels):
+        with profiling.stage('assemble'):
+            message = self.getCornerBytes(pixels, self.getNCells(), 1).decode('ascii')
+
+        return self.trim(message)
+
+    # strided slicing picks the top left pixel of every block, in row-major order
+    # return the channels of the first nCells of them, shifted right by shift, as bytes
+    # each band of rows of blocks is done on its own, in jobs threads (see parallel.py)
+    def getCornerBytes(self, pixels, nCells, shift=0):
+        nChan = pixels.shape[-1]
+
+        def cornerBand(top, bottom):
+            corners = pixels[top*self.blockY:bottom*self.blockY:self.blockY, ::self.blockX][:, :self.sizeX]
+            return (corners >> shift if shift else corners).tobytes()
+
+        nRows = math.ceil(nCells / self.sizeX)
+        return b''.join(parallel.mapBands(cornerBand, 0, nRows, self.jobs, itemSize=self.sizeX * nChan))[:nCells * nChan]
+
+    # the message as bytes
+    # in dense mode, the channels after the header are the message, as they are (then decompressed)
+    # otherwise, it is the ASCII message
+    @profiling.profiled
+    def getBytes(self):
+        if not self.isDense():
+            return self.getMessage().encode('ascii')
+
+        nCells = self.getNCells()
+        if np is not None:
+            with profiling.stage('asarray'):
+                pixels = np.asarray(self.image)
+            with profiling.stage('assemble'):
+                channels = self.getCornerBytes(pixels, nCells)
+        else:
+            with profiling.stage('assemble'):
+                channels = b''.join(self.iterChannels(0, nCells * len(self.image.getbands())))
+
+        channels = bytes(channels[ColorCode.HEADERLEN:self.getNChannels()])
+        if self.isSeven():
+            channels = ColorCode.unpackSeven(channels, self.length, self.jobs)
+        if self.getCodec() is not None:
+            with profiling.stage('decompress', codec=self.getCodec()):
+                return compression.decompress([channels], self.getCodec())
+        return channels
+
+    # maps every channel to channel // 2, the bytes equivalent of channelToChar
+    HALVE = bytes(i // 2 for i in range(256))
+
+    # the channels of one row of blocks
+    # crop out just the top row of pixels of the row of blocks and take every blockX-th pixel
+    def getRow(self, j):
+        nChan = len(self.image.getbands())
+        strip = self.image.crop((0, j*self.blockY, self.width, j*self.blockY+1)).tobytes()
+
+        if self.blockX == 1:
+            return strip[:self.sizeX*nChan]
+        elif np is not None:
+            return np.frombuffer(strip, dtype=np.uint8).reshape(-1, nChan)[::self.blockX][:self.sizeX].tobytes()
+        else:
+            row = bytearray(self.sizeX * nChan)
+            for channel in range(nChan):
+                row[channel::nChan] = strip[channel::self.blockX*nChan][:self.sizeX]
+            return bytes(row)
+
+    # the channels from start up to end, one row of blocks at a time
+    # channel k is in cell k // nChan, which is in row (k // nChan) // sizeX
+    def iterChannels(self, start, end):
+        rowLength = self.sizeX * len(self.image.getbands())
+        end = min(end, self.sizeX * self.sizeY * len(self.image.getbands()))
+        for j in range(start // rowLength, math.ceil(end / rowLength)):
+            yield self.getRow(j)[max(start - j*rowLength, 0):end - j*rowLength]
+
+    # generator version of getMessage, yielding the message one row of blocks at a time
+    # the full pixel list is never built, only one row of pixels per row of blocks is read
+    # offset and length select a range of characters, which maps to a range of rows
+    # with a header, offsets start after the header, and the message is exactly length characters long
+    # otherwise, as in getMessage, the NULLs, white boxes, and a final newline are stripped from the end
+    # since the end isn't known until the last row, hold back any characters that could be stripped
+    def iterMessage(self, offset=0, length=None):
+        if self.isDense():
+            yield from self.iterDense(offset, length)
+            return
+
+        start, end = offset, self.sizeX * self.sizeY * len(self.image.getbands())
+        if self.hasHeader:
+            start, end = ColorCode.HEADERLEN + offset, self.getNChannels()
+        if length is not None:
+            end = min(end, start + length)
 
+        pending = ''
+        for channels in self.iterChannels(start, end):
+            row = channels.translate(Decode.HALVE).decode('ascii')
+            if self.hasHeader:
+                text = row
+            else:
+                text = (pending + row).rstrip(chr(127)+chr(0)+"\n")
+                pending = (pending + row)[len(text):]
+            if text:
+                yield text
+
+    # iterMessage for dense mode, where offset and length count bytes
+    # the bytes are decoded as UTF-8 as they come
+    def iterDense(self, offset=0, length=None):
+        utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        if self.getCodec() is not None:
+            chunks = self.iterDecompressed(offset, length)
+        else:
+            chunks = self.iterDenseBytes(offset, length)
+        for data in chunks:
+            text = utf8.decode(data)
+            if text:
+                yield text
+        text = utf8.decode(b'', final=True)
+        if text:
+            yield text
+
+    # the bytes of a compressed message, decompressed one row of blocks at a time
+    # offset and length count decompressed bytes, so everything before offset still has to be decompressed
+    # but nothing after offset + length is read
+    def iterDecompressed(self, offset=0, length=None):
+        end = None if length is None else offset + length
+        position = 0
+        for data in compression.iterDecompress(self.iterDenseBytes(), self.getCodec()):
+            start, position = position, position + len(data)
+            yield data[max(offset - start, 0):len(data) if end is None else max(end - start, 0)]
+            if end is not None and position >= end:
+                return
+
+    # the bytes of a dense message, one row of blocks at a time
+    # when packed, characters come in groups of 8 in 7 channels, so start from the group holding offset
+    # and keep any channels that don't make a whole group for the next row
+    def iterDenseBytes(self, offset=0, length=None):
+        end = self.length if length is None else min(self.length, offset + length)
+        if offset >= end:
+            return
+
+        if not self.isSeven():
+            yield from self.iterChannels(ColorCode.HEADERLEN + offset, ColorCode.HEADERLEN + end)
+            return
+
+        first = offset - offset % 8
+        skip = offset - first
+        start = ColorCode.HEADERLEN + 7*first//8
+        remaining = self.getNChannels(end) - start
+        pending = b''
+        for channels in self.iterChannels(start, start + remaining):
+            pending += channels
+            remaining -= len(channels)
+            nChars = end - first if remaining <= 0 else min(8 * (len(pending) // 7), end - first)
+            nBytes = math.ceil(7 * nChars / 8)
+            data = ColorCode.unpackSeven(pending[:nBytes], nChars)
+            pending = pending[nBytes:]
+            first += nChars
+            yield data[skip:]
+            skip = max(skip - len(data), 0)
+
+
+###########################
+#### LIBRARY FUNCTIONS ####
+###########################
+
+# encode a message (str, or ASCII bytes; any bytes in dense mode) into a PIL Image
+# optionally compressing it with one of compression.CODECS, and in jobs threads
+def encode(message, block=(1, 1), ncols=None, nrows=None, header=True, dense=False, compress=None, jobs=1):
+    return ColorCode(message, block, ncols, nrows, header, dense, compress, jobs).toImage()
+
+# encode a message into an image file in memory, as bytes in fileFormat (see imagefile.dumpImage)
+# with an ImageCache (see cache.py), an image made before from the same message and options
+# is returned from the cache instead of being encoded again
+def encodeFile(message, block=(1, 1), ncols=None, nrows=None, header=True, dense=False, compress=None, jobs=1,
+               fileFormat='PNG', compressLevel=None, optimize=False, palette=False, imageCache=None):
+    def make():
+        image = encode(message, block, ncols, nrows, header, dense, compress, jobs)
+        with profiling.stage('save'):
+            return imagefile.dumpImage(image, fileFormat, compressLevel, optimize, palette)
+
+    if imageCache is None:
+        return make()
+    # jobs is left out, since it gives the same image
+    key = cache.makeKey(message, codec='colorcode', block=list(block), ncols=ncols, nrows=nrows, header=header, dense=dense,
+                        compress=compress, format=fileFormat, level=compressLevel, optimize=optimize, palette=palette)
+    with profiling.stage('cache'):
+        return imageCache.fetch(key, make)
+
+# decode a PIL Image (or array) into a message
+def decode(image, ncols=None, nrows=None, detect=False, jobs=1):
+    return Decode(image, ncols, nrows, detect, jobs).getMessage()
+
+# decode a PIL Image (or array) into a message, as bytes
+def decodeBytes(image, ncols=None, nrows=None, detect=False, jobs=1):
+    return Decode(image, ncols, nrows, detect, jobs).getBytes()
+
+# encode a message into a multi-frame file (APNG or TIFF) with frames of at most maxSize px (see FrameColorCode)
+def encodeFrames(message, fileName, block=(1, 1), ncols=None, nrows=None, dense=False, maxSize=(4096, 4096), jobs=1, compressLevel=None):
+    FrameColorCode(message, block, ncols, nrows, dense, maxSize, jobs).write(fileName, compressLevel)
+
+# decode every frame of an image file in order, or only frame index, reading and decoding one frame at a time
+# and yield the message of each as it is decoded; dense frames are bytes, decoded as UTF-8 across frames
+def iterFrames(fileName, index=None, jobs=1):
+    utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with imagefile.FrameReader(fileName) as reader:
+        for idx in (range(len(reader)) if index is None else [index]):
+            with profiling.stage('frame', index=idx):
+                decoder = Decode(reader.getFrame(idx), jobs=jobs)
+                text = utf8.decode(decoder.getBytes()) if decoder.isDense() else decoder.getMessage()
+            yield text
+    yield utf8.decode(b'', final=True)
+
+# decode every frame of an image file (or only frame index) into a message
+def decodeFrames(fileName, index=None, jobs=1):
+    return ''.join(iterFrames(fileName, index, jobs))
 
 ###############################
 #### MAIN ARGPARSE AND RUN ####
@@ -236,26 +1050,220 @@ class Decode():
 # - provide an output file or accept that default of image.png
 # - provide either ncols or nrows or neither; neither --> squareish, ncols takes precedence over nrows
 # - provide a block size, i.e. the size of a block, width and height, e.g. 20 x 20 px blocks
+# - specify --stream to read the input file and write the image one row at a time
+# - specify --noheader to leave out the header, e.g. for short names; the dimensions are then needed to decode
+# - specify --dense to store any bytes (e.g. UTF-8) 8 bits per channel, instead of 2 * ASCII value
+# - specify --compress zlib, lzma, or bz2 to compress the message first (implies --dense)
+# - the output file extension gives the format: .png (default), .ppm, .bmp, or .npy
+# - specify --level 0-9 and --optimize to control PNG compression, and --palette to save a palette image if possible
+# - specify --cache to reuse the image from an earlier run with the same message and options (see cache.py),
+#   optionally giving its directory, and --cachesize to bound it in MB (not with --stream, or other extensions)
+
+# in multi-frame mode
+# - specify --maxsize W H to split a message too large for one image across frames of at most W x H px each,
+#   written to an animated PNG (.png or .apng) or a multi-page TIFF (.tif or .tiff), one frame at a time
+# - every frame has a header and is decoded on its own; --ncols and --nrows can make the frames smaller
+# - not with --stream, --compress, or --noheader
+
+# in append mode
+# - specify --append, to add the input TEXT to the end of the message in the output image, which needs a header
+# - the number of columns stays the same (--ncols, if given, must match), and so does the block size and mode
+# - if the output file doesn't exist yet, it is created as in encode mode
+# - PPM, NPY, and BMP files written by --stream are changed in place, so an append only costs as much as the new text;
+#   PNG files have to be compressed again
 
 # in decode mode
 # - specify --decode
 # - provide an input IMAGE file
-# - provide BOTH ncols and nrows, informing the program how many blocks there are, or neither, assuming they're 1 x 1
+# - images with a header (the default when encoding) need nothing else
+# - the input image can be PNG, PPM, BMP, NPY, or anything else Pillow can open
+# - otherwise, provide BOTH ncols and nrows, informing the program how many blocks there are, or neither, detecting the block size
+#   (either one alone fixes the block width or height, and the other is detected)
+# - specify --nodetect to assume the block size is 1 x 1 instead
+# - a detected block larger than 1 x 1 is only a guess, since runs of identical colors can make it look larger,
+#   so a warning is printed
 # - can use the output line from the previous step
+# - specify --stream to print the message as it is decoded, or --offset and --length to decode part of it
+# - files with several frames are decoded one frame at a time, printing each as it is decoded;
+#   specify --frame K to decode only frame K (from 0), without decoding the ones before it
+
+# in either mode
+# - specify --jobs N to split the work on a large image across N threads (0 for every CPU), with NumPy
+#   (not with --stream, nor when decoding with --stream, --offset, or --length)
+# - specify --profile to print the time and memory of each stage to stderr, as a table (default), json, or jsonl
+
+# read the message from the input file or from stdin
+# in dense mode, read the file as bytes
+def readMessage(fileName, dense=False):
+    if fileName == '-':
+        message = input('{}: {}'.format(bold('Enter message here'), colorize('', 'blue', False)))
+        print('\033[m', end='')
+        return message
+
+    try:
+        with profiling.stage('read'):
+            message = open(fileName, 'rb' if dense else 'r').read()
+    except:
+        raise Exception('Error reading from {}'.format(fileName))
+    print('Reading text from {}'.format(bold(fileName)))
+    return message
+
+# open an image file, memory mapping it if it is uncompressed
+def readImage(fileName):
+    try:
+        with profiling.stage('open'):
+            return imagefile.openImage(fileName, mapped=True)
+    except:
+        raise Exception('Error when trying to open image file {}'.format(bold(fileName)))
+
+# print the image size (width, height) in px and how to decode it
+# the dimensions are only needed if there is no header, or if the block size is too large for it
+def printSummary(size, fileName, block, header=True):
+    (width, height), (blockX, blockY) = size, block
+    print('{} created: {} x {} px, {} x {} colors'.format(
+        bold(fileName),
+        width,
+        height,
+        width // blockX,
+        height // blockY,
+    ))
+    command = 'python colorcode.py --decode --inputfile {}'.format(fileName)
+    if not header or blockX >= 128 or blockY >= 128:
+        command += ' --ncols {} --nrows {}'.format(width // blockX, height // blockY)
+    print('Decode {} with : {}'.format(
+        bold(fileName),
+        colorize(command, 'pink')
+    ))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('-i' , '--inputfile' , dest='INPUT' , default='-'        ,                    help='input filename or - for raw input')
+    parser.add_argument('-o' , '--outputfile', dest='OUTPUT', default='image.png',                    help='output filename'                  )
+    parser.add_argument('-nr', '--nrows'     , dest='NROWS' , default=None       ,          type=int, help='number of rows'                   )
+    parser.add_argument('-nc', '--ncols'     , dest='NCOLS' , default=None       ,          type=int, help='number of columns'                )
+    parser.add_argument('-b' , '--blocksize' , dest='BLOCK' , default=[1, 1]     , nargs=2, type=int, help='block size X Y to scale up'       )
+    parser.add_argument('-d' , '--decode'    , dest='DECODE', action='store_true',                    help='whether to decode an image file'  )
+    parser.add_argument('-s' , '--stream'    , dest='STREAM', action='store_true',                    help='whether to stream the input file' )
+    parser.add_argument('-a' , '--append'    , dest='APPEND', action='store_true',                    help='whether to add to the output image' )
+    parser.add_argument(        '--offset'    , dest='OFFSET', default=0          ,          type=int, help='first character to decode'        )
+    parser.add_argument(        '--length'    , dest='LENGTH', default=None       ,          type=int, help='number of characters to decode'   )
+    parser.add_argument(        '--noheader'  , dest='HEADER', action='store_false',                   help='whether to leave out the header'  )
+    parser.add_argument(        '--nodetect'  , dest='DETECT', action='store_false',                   help='whether to assume 1 x 1 px blocks' )
+    parser.add_argument(        '--dense'     , dest='DENSE' , action='store_true',                    help='whether to store 8 bits per channel')
+    parser.add_argument(        '--compress'  , dest='COMPRESS', default=None     , choices=compression.CODECS, help='codec to compress the message with')
+    parser.add_argument(        '--level'     , dest='LEVEL' , default=None       , type=int, choices=range(10), help='PNG compression level, 0 to 9'   )
+    parser.add_argument(        '--optimize'  , dest='OPTIMIZE', action='store_true',                  help='whether to make the PNG as small as possible')
+    parser.add_argument(        '--palette'   , dest='PALETTE', action='store_true',                   help='whether to save with a palette if possible')
+    parser.add_argument(        '--maxsize'   , dest='MAXSIZE', default=None      , nargs=2, type=int, help='largest frame size W H in px, to split across frames')
+    parser.add_argument(        '--frame'     , dest='FRAME' , default=None       ,          type=int, help='frame to decode'                  )
+    parser.add_argument(        '--cache'     , dest='CACHE' , default=None       , nargs='?', const=cache.CACHEDIR, help='whether to use a cache of images, and its directory')
+    parser.add_argument(        '--cachesize' , dest='CACHESIZE', default=cache.MAXSIZE // 2**20, type=int, help='largest size of the cache, in MB')
+    parser.add_argument('-j' , '--jobs'      , dest='JOBS'  , default=1          ,          type=int, help='number of threads, 0 for all CPUs')
+    parser.add_argument(        '--profile'   , dest='PROFILE', default=None     , nargs='?', const='table', choices=profiling.FORMATS, help='print the time and memory of each stage')
+    args = parser.parse_args(argv)
+
+    with profiling.profile(args.PROFILE):
+        if args.DECODE:
+            decodeMain(args)
+        elif args.APPEND and os.path.exists(args.OUTPUT):
+            appendMain(args)
+        else:
+            encodeMain(args)
+
+# encode mode: read the message (or stream the input file) and write the image
+def encodeMain(args):
+    if args.MAXSIZE is not None:
+        if args.STREAM or args.COMPRESS is not None or not args.HEADER:
+            raise Exception('Frames cannot be used with --stream, --compress, or --noheader')
+        image = FrameColorCode(readMessage(args.INPUT, args.DENSE), args.BLOCK, args.NCOLS, args.NROWS, args.DENSE, args.MAXSIZE, args.JOBS)
+        image.write(args.OUTPUT, args.LEVEL)
+        print('Split across {} frames'.format(bold(image.nFrames)))
+        printSummary((image.sizeX*image.blockX, image.sizeY*image.blockY), args.OUTPUT, args.BLOCK)
+        return
+
+    if args.STREAM:
+        if args.INPUT == '-':
+            raise Exception('Streaming mode requires an input file')
+        image = StreamColorCode(args.INPUT, args.BLOCK, args.NCOLS, args.NROWS, args.HEADER, args.DENSE, args.COMPRESS)
+        print('Streaming text from {}'.format(bold(args.INPUT)))
+        image.write(args.OUTPUT, args.LEVEL, args.OPTIMIZE, args.PALETTE)
+        printSummary((image.sizeX*image.blockX, image.sizeY*image.blockY), args.OUTPUT, args.BLOCK, args.HEADER)
+        return
+
+    message = readMessage(args.INPUT, args.DENSE or args.COMPRESS is not None)
+    if args.CACHE is not None and imagefile.getFormat(args.OUTPUT) is not None:
+        saved = writeCached(message, args)
+    else:
+        image = ColorCode(message, args.BLOCK, args.NCOLS, args.NROWS, args.HEADER, args.DENSE, args.COMPRESS, args.JOBS)
+        saved = image.write(args.OUTPUT, args.LEVEL, args.OPTIMIZE, args.PALETTE)
+    if args.PALETTE and saved.mode != 'P':
+        print('Image has more than 256 colors (or is not PNG or BMP), so it was saved without a palette')
+    printSummary(saved.size, args.OUTPUT, args.BLOCK, args.HEADER)
+
+# encode mode with --cache: get the file from the cache, encoding it only if it isn't there, and write it
+# return the image as it was saved, as for ColorCode.write
+def writeCached(message, args):
+    imageCache = cache.ImageCache(args.CACHE, args.CACHESIZE * 2**20, memorySize=0)
+    fileFormat = imagefile.getFormat(args.OUTPUT)
+    data = encodeFile(message, args.BLOCK, args.NCOLS, args.NROWS, args.HEADER, args.DENSE, args.COMPRESS, args.JOBS,
+                      fileFormat, args.LEVEL, args.OPTIMIZE, args.PALETTE, imageCache)
+    try:
+        with profiling.stage('write'):
+            with open(args.OUTPUT, 'wb') as outFile:
+                outFile.write(data)
+    except:
+        raise Exception('Error when trying to write to {}'.format(bold(args.OUTPUT)))
+    print('{} the cache in {}'.format('Found in' if imageCache.stats['hits'] else 'Added to', bold(args.CACHE)))
+    if fileFormat == 'NPY':
+        return imagefile.loadImage(data)
+    return Image.open(io.BytesIO(data))
+
+# append mode: add the message to the end of the one in the output image
+# the input file is read as bytes, since the mode of the image isn't known until its header is read
+def appendMain(args):
+    image = AppendColorCode(args.OUTPUT, readMessage(args.INPUT, dense=True), args.NCOLS, args.JOBS)
+    inPlace = image.write(args.LEVEL, args.OPTIMIZE, args.PALETTE)
+    print('Appended {} characters to {} ({}), which now holds {}'.format(
+        bold(image.length - image.oldLength),
+        bold(args.OUTPUT),
+        'in place' if inPlace else 'rewritten',
+        bold(image.length),
+    ))
+    printSummary((image.sizeX*image.blockX, image.sizeY*image.blockY), args.OUTPUT, (image.blockX, image.blockY))
+
+# decode mode: read the image and print the message
+def decodeMain(args):
+    if args.FRAME is not None or imagefile.hasFrames(args.INPUT):
+        try:
+            nFrames = imagefile.countFrames(args.INPUT)
+        except OSError:
+            raise Exception('Error when trying to open image file {}'.format(bold(args.INPUT)))
+        print('Attempting to decode {} ({}):\n'.format(
+            bold(args.INPUT),
+            '{} frames'.format(nFrames) if args.FRAME is None else 'frame {} of {}'.format(args.FRAME, nFrames)
+        ))
+        for text in iterFrames(args.INPUT, args.FRAME, args.JOBS):
+            print(colorize(text, 'blue'), end='', flush=True)
+        print()
+        return
+
+    decoder = Decode(readImage(args.INPUT), args.NCOLS, args.NROWS, args.DETECT, args.JOBS)
+    if not decoder.hasHeader and (args.NCOLS is None or args.NROWS is None):
+        print('Color dimensions not specified; {} block size = {}'.format(
+            'detected' if args.DETECT else 'assuming',
+            bold('{} x {} px'.format(decoder.blockX, decoder.blockY))
+        ))
+        if args.DETECT and (decoder.blockX, decoder.blockY) != (1, 1):
+            print(colorize('Warning: a detected block size can be too large; if the message looks wrong, use --nodetect or give --ncols and --nrows', 'red'))
+    print('Attempting to decode {}:\n'.format(bold(args.INPUT)))
+
+    if args.STREAM or args.OFFSET or args.LENGTH is not None:
+        for text in decoder.iterMessage(args.OFFSET, args.LENGTH):
+            print(colorize(text, 'blue'), end='', flush=True)
+        print()
+
+    else:
+        print(colorize(decoder.getMessage(), 'blue'))
 
-parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
-parser.add_argument('-i' , '--inputfile' , dest='INPUT' , default='-'        ,                    help='input filename or - for raw input')
-parser.add_argument('-o' , '--outputfile', dest='OUTPUT', default='image.png',                    help='output filename'                  )
-parser.add_argument('-nr', '--nrows'     , dest='NROWS' , default=None       ,          type=int, help='number of rows'                   )
-parser.add_argument('-nc', '--ncols'     , dest='NCOLS' , default=None       ,          type=int, help='number of columns'                )
-parser.add_argument('-b' , '--blocksize' , dest='BLOCK' , default=[1, 1]     , nargs=2, type=int, help='block size X Y to scale up'       )
-parser.add_argument('-d' , '--decode'    , dest='DECODE', action='store_true',                    help='whether to decode an image file'  )
-args = parser.parse_args()
-
-if not args.DECODE:
-    image = ColorCode(args)
-    image.write()
-
-else:
-    decoder = Decode(args)
-    print(colorize(decoder.getMessage(), 'blue'))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import bz2
+import lzma
+import tempfile
+import zlib
+
+################
+#### CODECS ####
+################
+
+# the codecs a message can be compressed with, in the order of their number in the header flags
+# 0 means not compressed, so the first codec is 1
+CODECS = ('zlib', 'lzma', 'bz2')
+
+COMPRESSORS = {
+    'zlib': lambda: zlib.compressobj(9),
+    'lzma': lzma.LZMACompressor,
+    'bz2' : bz2.BZ2Compressor,
+}
+
+DECOMPRESSORS = {
+    'zlib': zlib.decompressobj,
+    'lzma': lzma.LZMADecompressor,
+    'bz2' : bz2.BZ2Decompressor,
+}
+
+# size of the pieces that large inputs are read and compressed in
+CHUNKSIZE = 2**20
+
+# the number to record in the header for a codec name (0 for None)
+def codecNumber(name):
+    if name is None:
+        return 0
+    if name not in CODECS:
+        raise Exception('Unknown compression codec {}'.format(name))
+    return CODECS.index(name) + 1
+
+# the codec name for a number read from the header (None for 0)
+def codecName(number):
+    if number == 0:
+        return None
+    if number > len(CODECS):
+        raise Exception('Unknown compression codec number {}'.format(number))
+    return CODECS[number - 1]
+
+#####################
+#### COMPRESSION ####
+#####################
+
+# compress an iterable of chunks of bytes, yielding the compressed bytes as they come
+# most chunks give nothing until the compressor has enough for a block
+def iterCompress(chunks, name):
+    compressor = COMPRESSORS[name]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# compress bytes, CHUNKSIZE at a time
+def compress(data, name):
+    view = memoryview(data)
+    return b''.join(iterCompress((view[idx:idx+CHUNKSIZE] for idx in range(0, len(view), CHUNKSIZE)), name))
+
+# compress a file into a temporary file, CHUNKSIZE at a time
+# small results stay in memory, and large ones spill over to disk
+# return the temporary file, rewound to the start, and its size
+def compressFile(fileName, name):
+    output = tempfile.SpooledTemporaryFile(max_size=16*CHUNKSIZE)
+    with open(fileName, 'rb') as inFile:
+        for data in iterCompress(iter(lambda: inFile.read(CHUNKSIZE), b''), name):
+            output.write(data)
+    size = output.tell()
+    output.seek(0)
+    return output, size
+
+#######################
+#### DECOMPRESSION ####
+#######################
+
+# decompress an iterable of chunks of compressed bytes, yielding the bytes as they come
+# so that the message can be decoded a piece of the image at a time
+def iterDecompress(chunks, name):
+    decompressor = DECOMPRESSORS[name]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if name == 'zlib':
+        yield decompressor.flush()
+
+# decompress an iterable of chunks of compressed bytes
+# stop as soon as there are length bytes, if given
+def decompress(chunks, name, length=None):
+    message = bytearray()
+    for data in iterDecompress(chunks, name):
+        message += data
+        if length is not None and len(message) >= length:
+            return bytes(message[:length])
+    return bytes(message)
@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+import client
+import colorcode
+import imagefile
+import steganography
+
+# a long-running server for both scripts, so that every request doesn't pay for starting Python
+# and importing Pillow: requests come in over a Unix socket or TCP (see client.py for the protocol)
+# and the work is done in a pool of worker processes that have already imported and warmed up everything
+# small requests are done right away in the server process, since sending them to a worker costs more
+# than the work itself
+
+#####################
+#### WORKER SIDE ####
+#####################
+
+# read the image of a request, from its file (memory mapped if only decoding) or from the body
+def getImage(request, body, mapped=False):
+    if request.get('input') is not None:
+        return imagefile.openImage(request['input'], mapped)
+    if not body:
+        raise Exception('No image given')
+    return imagefile.loadImage(body)
+
+# write the image of a request to its file, or return it as bytes for the body
+def putImage(request, image):
+    options = (request.get('level'), request.get('optimize', False), request.get('palette', False))
+    if request.get('output') is not None:
+        imagefile.saveImage(image, request['output'], *options)
+        return b''
+    fileFormat = imagefile.FORMATS.get('.' + request.get('format', 'png').lower())
+    if fileFormat is None:
+        raise Exception('Unknown image format {}'.format(request.get('format')))
+    return imagefile.dumpImage(image, fileFormat, *options)
+
+def encode(request, body):
+    message = request['message'] if request.get('message') is not None else body
+    coder = colorcode.ColorCode(
+        message,
+        tuple(request.get('block', (1, 1))),
+        request.get('ncols'),
+        request.get('nrows'),
+        request.get('header', True),
+        request.get('dense', False),
+        request.get('compress'),
+    )
+    body = putImage(request, coder.toImage())
+    return {'ncols': coder.sizeX, 'nrows': coder.sizeY, 'width': coder.sizeX*coder.blockX, 'height': coder.sizeY*coder.blockY}, body
+
+def decode(request, body):
+    decoder = colorcode.Decode(getImage(request, body, True), request.get('ncols'), request.get('nrows'), request.get('detect', False))
+    if request.get('offset') or request.get('length') is not None:
+        message = ''.join(decoder.iterMessage(request.get('offset', 0), request.get('length')))
+    else:
+        message = decoder.getMessage()
+    return {'message': message}, b''
+
+def embed(request, body):
+    coder = steganography.SteganographyCode(
+        getImage(request, body),
+        request['message'],
+        request.get('header', True),
+        request.get('depth', 1),
+        request.get('compress'),
+    )
+    if coder.size > coder.capacity():
+        raise Exception('Image is not big enough to hold the whole message')
+    return {'capacity': coder.capacity(), 'size': coder.size}, putImage(request, coder.toImage())
+
+def extract(request, body):
+    return {'message': steganography.extract(getImage(request, body, True), request.get('length'))}, b''
+
+OPS = {
+    'encode' : encode,
+    'decode' : decode,
+    'embed'  : embed,
+    'extract': extract,
+}
+
+# run one request, in a worker or in the server
+# return whether it worked, the result (or error), and the body
+def runRequest(request, body):
+    try:
+        result, body = OPS[request['op']](request, body)
+        return True, result, body
+    except Exception as error:
+        return False, '{}: {}'.format(type(error).__name__, error), b''
+
+# run once in every worker as it starts, so that the first real request doesn't pay for
+# the imports and first calls inside Pillow (and NumPy, if it is installed)
+def warmUp():
+    image = imagefile.loadImage(imagefile.dumpImage(colorcode.encode('warm up', block=(16, 16))))
+    colorcode.decode(steganography.embed(image, 'warm up'))
+    steganography.extract(image)
+
+# nothing, to make the pool start its workers
+def ping():
+    return os.getpid()
+
+#####################
+#### SERVER SIDE ####
+#####################
+
+# the number of pixels a request works on, found without doing the work: at most the grid times the block
+# for encode (see ColorCode.computeDimensions), or the size of the image in the body, or None if it can't be read
+def countPixels(request, body):
+    if request.get('op') == 'encode':
+        message = request['message'] if request.get('message') is not None else body
+        blocks = -(-(len(message) + colorcode.ColorCode.HEADERLEN) // colorcode.ColorCode.RGBLEN)
+        side = request.get('ncols') or request.get('nrows')
+        if side:
+            cells = side * -(-blocks // side)
+        else:
+            cells = (math.isqrt(blocks) + 1)**2
+        blockX, blockY = request.get('block', (1, 1))
+        return cells * blockX * blockY
+    try:
+        width, height = imagefile.sizeImage(body)
+    except Exception:
+        return None
+    return width * height
+
+class Server():
+
+    # workers is the number of worker processes (default: number of CPUs)
+    # maxJobs is how many requests can be in progress at once, across all connections (default: 2 per worker)
+    # requests with at most inlineSize bytes of message and image, at most inlinePixels pixels (see countPixels),
+    # and no files, are done in the server
+    # root is the directory that the files of requests must be in (default: anywhere on a Unix socket,
+    # and no files at all on TCP, where any local user can connect, so images must be sent as bodies)
+    def __init__(self, workers=None, maxJobs=None, inlineSize=4096, inlinePixels=65536, root=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.maxJobs = maxJobs or 2*self.workers
+        self.inlineSize = inlineSize
+        self.inlinePixels = inlinePixels
+        self.root = None if root is None else os.path.realpath(root)
+        self.files = True
+        self.pool = None
+        self.stats = {'connections': 0, 'requests': 0, 'errors': 0, 'inline': 0, 'running': 0, 'waiting': 0, 'ops': {}}
+
+    # start the workers and wait until they have all warmed up
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.maxJobs)
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'), warmUp)
+        await asyncio.gather(*[loop.run_in_executor(self.pool, ping) for i in range(self.workers)])
+        warmUp()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def isInline(self, request, body):
+        if request.get('input') is not None or request.get('output') is not None:
+            return False
+        if len(body) + len(request.get('message') or '') > self.inlineSize:
+            return False
+        pixels = countPixels(request, body)
+        return pixels is not None and pixels <= self.inlinePixels
+
+    # check that the files of a request are allowed, replacing them with their real paths
+    # so that a symbolic link can't lead outside root; return the error if not
+    def checkFiles(self, request):
+        for key in ('input', 'output'):
+            if request.get(key) is None:
+                continue
+            if not self.files:
+                return 'Files are not allowed here; send the image instead'
+            path = os.path.realpath(request[key])
+            if self.root is not None and os.path.commonpath((path, self.root)) != self.root:
+                return 'File {} is outside {}'.format(request[key], self.root)
+            request[key] = path
+        return None
+
+    # answer one request, and record how long it took
+    async def answer(self, request, body):
+        start = time.perf_counter()
+        op = request.get('op')
+        error = self.checkFiles(request)
+        if op == 'ping':
+            ok, result, body = True, {'pid': os.getpid()}, b''
+        elif op == 'stats':
+            ok, result, body = True, self.stats, b''
+        elif op not in OPS:
+            ok, result, body = False, 'Unknown op {}'.format(op), b''
+        elif error is not None:
+            ok, result, body = False, error, b''
+        elif self.isInline(request, body):
+            self.stats['inline'] += 1
+            ok, result, body = runRequest(request, body)
+        else:
+            try:
+                ok, result, body = await asyncio.get_running_loop().run_in_executor(self.pool, runRequest, request, body)
+            except Exception as error:
+                ok, result, body = False, '{}: {}'.format(type(error).__name__, error), b''
+
+        self.stats['requests'] += 1
+        self.stats['errors'] += not ok
+        opStats = self.stats['ops'].setdefault(op, {'count': 0, 'seconds': 0.})
+        opStats['count'] += 1
+        opStats['seconds'] += time.perf_counter() - start
+
+        header = {'id': request.get('id'), 'ok': ok, 'result' if ok else 'error': result}
+        return client.makeFrame(header, body)
+
+    # answer one request and send the response, then free its slot
+    # responses on one connection are sent as they are ready, so they can come back out of order
+    async def respond(self, request, body, writer, lock):
+        try:
+            frame = await self.answer(request, body)
+            async with lock:
+                writer.write(frame)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.stats['running'] -= 1
+            self.slots.release()
+
+    # read requests from one connection until it closes
+    # a slot is taken after the lengths of the next request are read, but before its header and body,
+    # so once maxJobs requests are in progress, nothing more is read from any connection: clients then
+    # block sending, which is the backpressure, and at most maxJobs requests are ever in memory
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    prefix = await reader.readexactly(client.FRAME.size)
+                except asyncio.IncompleteReadError:
+                    break
+                headerLength, bodyLength = client.checkFrame(prefix)
+
+                self.stats['waiting'] += 1
+                await self.slots.acquire()
+                self.stats['waiting'] -= 1
+                try:
+                    request = json.loads((await reader.readexactly(headerLength)).decode('utf-8'))
+                    body = await reader.readexactly(bodyLength)
+                except BaseException:
+                    self.slots.release()
+                    raise
+                self.stats['running'] += 1
+                task = asyncio.ensure_future(self.respond(request, body, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except Exception as error:
+            print('Closing connection: {}: {}'.format(type(error).__name__, error), file=sys.stderr)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    # serve on a Unix socket at path, or on TCP at host and port if port is given, until cancelled
+    # SIGTERM cancels it too, where there are signals
+    # the Unix socket can only be used by its owner; on TCP, files need a root (see __init__)
+    async def serve(self, path=client.SOCKET, host=client.HOST, port=None):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, AttributeError):
+            pass
+        await self.start()
+        if port is None:
+            removeStaleSocket(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+            os.chmod(path, 0o600)
+            address = path
+        else:
+            self.files = self.root is not None
+            server = await asyncio.start_server(self.handle, host, port)
+            for sock in server.sockets:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = '{}:{}'.format(host, port)
+        print('Listening on {} with {} workers'.format(address, self.workers), file=sys.stderr, flush=True)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if port is None and os.path.exists(path):
+                os.unlink(path)
+
+# remove a Unix socket left over from a daemon that is no longer running
+# but not one that a daemon is still listening on
+def removeStaleSocket(path):
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Exception('A daemon is already listening on {}'.format(path))
+
+###############################
+#### MAIN ARGPARSE AND RUN ####
+###############################
+
+# - listen on a Unix socket (default: colorcode.sock in the temporary directory), or on TCP with --port
+# - specify --workers, --maxjobs, --inline, and --inlinepixels to tune it (see Server)
+# - specify --root to only read and write image files in that directory; on TCP, without --root,
+#   clients can't name files at all and must use --send
+# stop it with Ctrl-C or SIGTERM
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument(       '--socket'    , dest='SOCKET'  , default=client.SOCKET,                  help='Unix socket to listen on'          )
+    parser.add_argument(       '--host'      , dest='HOST'    , default=client.HOST  ,                  help='host to listen on, with --port'    )
+    parser.add_argument(       '--port'      , dest='PORT'    , default=None         ,        type=int, help='TCP port to listen on'             )
+    parser.add_argument('-j' , '--workers'   , dest='WORKERS' , default=None         ,        type=int, help='number of worker processes'        )
+    parser.add_argument(       '--maxjobs'   , dest='MAXJOBS' , default=None         ,        type=int, help='number of requests in progress at once')
+    parser.add_argument(       '--inline'    , dest='INLINE'  , default=4096         ,        type=int, help='largest request to do without a worker, in bytes')
+    parser.add_argument(       '--inlinepixels', dest='INLINEPIXELS', default=65536,        type=int, help='largest image to do without a worker, in pixels')
+    parser.add_argument(       '--root'      , dest='ROOT'    , default=None         ,                  help='directory that image files must be in')
+    args = parser.parse_args(argv)
+
+    server = Server(args.WORKERS, args.MAXJOBS, args.INLINE, args.INLINEPIXELS, args.ROOT)
+    try:
+        asyncio.run(server.serve(args.SOCKET, args.HOST, args.PORT))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
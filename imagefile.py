@@ -0,0 +1,775 @@
+import ast
+import io
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from PIL import Image, TiffImagePlugin, features
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# reading and writing image files for both scripts
+# the format is chosen by the file extension:
+# PNG is compressed, with a choice of compression level, and optionally a palette
+# PPM, BMP, and NPY (NumPy's array format) are raw pixels, quick to write and to read again
+# NPY files are read and written without NumPy, so it stays optional
+# APNG and multi-page TIFF hold several images of the same size, as frames (see MULTI-FRAME FILES)
+# for decoding, the raw formats can also be memory mapped instead of read (see MappedImage)
+
+#################
+#### FORMATS ####
+#################
+
+FORMATS = {
+    '.png': 'PNG',
+    '.ppm': 'PPM',
+    '.bmp': 'BMP',
+    '.npy': 'NPY',
+    '.apng': 'PNG',
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+}
+
+# the format for a file name, from its extension
+# None for any other extension, which is left to Pillow
+def getFormat(fileName):
+    return FORMATS.get(os.path.splitext(fileName)[1].lower())
+
+# the same image in P mode, with a palette of exactly its colors, or None if it has more than 256
+# quantizing to a palette holding every color of the image maps every pixel to its own color
+def toPalette(image):
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(bytes(channel for count, color in colors for channel in color))
+    return image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+#############
+#### NPY ####
+#############
+
+# an NPY file is a magic string, a version, the length of the header, and the header,
+# a Python dictionary literal giving the type, order, and shape of the array, padded so that
+# the data starts on a multiple of 64 bytes; then the data itself, in this case one byte per channel
+NPYMAGIC = b'\x93NUMPY'
+NPYALIGN = 64
+NPYMODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+def makeNPYHeader(width, height, nChan):
+    shape = (height, width) if nChan == 1 else (height, width, nChan)
+    header = "{{'descr': '|u1', 'fortran_order': False, 'shape': {}, }}".format(shape)
+    header += ' ' * (-(len(NPYMAGIC) + 4 + len(header) + 1) % NPYALIGN) + '\n'
+    return NPYMAGIC + b'\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1')
+
+# read the header of an open NPY file
+# return the mode, the size, and the offset of the data
+def readNPYHeader(inFile):
+    if inFile.read(len(NPYMAGIC)) != NPYMAGIC:
+        raise Exception('Not an NPY file')
+    major, minor = inFile.read(2)
+    lengthFormat = '<H' if major == 1 else '<I'
+    length, = struct.unpack(lengthFormat, inFile.read(struct.calcsize(lengthFormat)))
+    header = ast.literal_eval(inFile.read(length).decode('latin-1'))
+
+    shape = header['shape']
+    nChan = 1 if len(shape) == 2 else shape[2]
+    if header['descr'] not in ('|u1', '<u1', '>u1', 'u1') or header['fortran_order'] or nChan not in NPYMODES:
+        raise Exception('NPY file is not an image array of bytes')
+    return NPYMODES[nChan], (shape[1], shape[0]), inFile.tell()
+
+def isNPY(fileName):
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(len(NPYMAGIC)) == NPYMAGIC
+
+# read or write an NPY image from or to an open file
+def readNPY(inFile):
+    mode, size, offset = readNPYHeader(inFile)
+    return Image.frombytes(mode, size, inFile.read())
+
+def writeNPY(image, outFile):
+    outFile.write(makeNPYHeader(*image.size, len(image.getbands())))
+    outFile.write(image.tobytes())
+
+########################
+#### MEMORY MAPPING ####
+########################
+
+# the pixels of an uncompressed image file, memory mapped, without reading or copying them
+# only the pages holding the pixels that are actually used are ever read from disk,
+# so a large image can be decoded with little more memory than the part of it that is decoded
+# it has the parts of the PIL Image interface that the decoders use:
+# np.asarray gives a read-only array straight on the mapping, crop gives a band of rows as another
+# MappedImage on the same mapping, and everything else converts only the rows it needs to a PIL Image
+# (transpose, which needs every row, converts the whole image)
+# rows are stride bytes apart, starting at offset for the top row; the stride is negative if the file
+# stores the rows bottom up; rawmode is the order of the channels in the file, as Pillow names it
+class MappedImage():
+
+    # for each rawmode, which of its channels make up a pixel, as an index or a slice
+    RAWMODES = {
+        'L'   : 0,
+        'RGB' : slice(None),
+        'RGBA': slice(None),
+        'BGR' : slice(None, None, -1),
+        'BGRX': slice(2, None, -1),
+        'RGBX': slice(0, 3),
+    }
+
+    # number of bytes of rows to convert at a time in getdata
+    BANDSIZE = 2**20
+
+    def __init__(self, buffer, mode, size, offset, stride, rawmode):
+        self.buffer = buffer
+        self.mode = mode
+        self.size = size
+        self.width, self.height = size
+        self.offset = offset
+        self.stride = stride
+        self.rawmode = rawmode
+        self.pixelSize = len(rawmode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # the mapping can't be closed while arrays on it still exist; it is then closed once they are gone
+    # (bytes in memory, see shareImage, have nothing to close)
+    def close(self):
+        try:
+            self.buffer.close()
+        except (BufferError, AttributeError):
+            pass
+
+    # nothing to do, the pixels are read when they are used
+    def load(self):
+        pass
+
+    # write rows of pixels (full rows, as bytes in mode) from row top, converted to the file's layout
+    # only on a writable mapping (see extendImage)
+    def putRows(self, top, data):
+        rowSize = self.width * self.pixelSize
+        nRows = len(data) // (self.width * len(self.getbands()))
+        if self.rawmode != self.mode:
+            data = Image.frombytes(self.mode, (self.width, nRows), data).tobytes('raw', self.rawmode)
+        if self.stride == rowSize:
+            position = self.offset + top * self.stride
+            self.buffer[position:position + nRows * rowSize] = data
+            return
+        for y in range(nRows):
+            position = self.offset + (top + y) * self.stride
+            self.buffer[position:position + rowSize] = data[y * rowSize:(y + 1) * rowSize]
+
+    # write any changed pages back to the file
+    def flush(self):
+        self.buffer.flush()
+
+    def getbands(self):
+        return tuple(self.mode) if self.mode != 'L' else ('L',)
+
+    # the position of the lowest row in the file, and the number of bytes from it to the end of the highest
+    def getExtent(self):
+        low = self.offset + (self.height - 1) * min(self.stride, 0)
+        return low, (self.height - 1) * abs(self.stride) + self.width * self.pixelSize
+
+    def getpixel(self, xy):
+        x, y = xy
+        position = self.offset + y * self.stride + x * self.pixelSize
+        value = self.buffer[position:position+self.pixelSize][MappedImage.RAWMODES[self.rawmode]]
+        return value if isinstance(value, int) else tuple(value)
+
+    # a box of whole rows is another MappedImage; any other box is cropped from a PIL Image of its rows
+    def crop(self, box):
+        left, top, right, bottom = box
+        band = MappedImage(self.buffer, self.mode, (self.width, bottom - top), self.offset + top * self.stride, self.stride, self.rawmode)
+        if (left, right) == (0, self.width):
+            return band
+        return band.toImage().crop((left, 0, right, bottom - top))
+
+    # a PIL Image holding a copy of the pixels, made by Pillow's raw decoder straight from the file layout
+    # (a negative ystep reads the rows bottom up)
+    def toImage(self):
+        low, length = self.getExtent()
+        data = self.buffer[low:low + self.height * abs(self.stride)]
+        return Image.frombytes(self.mode, self.size, data, 'raw', self.rawmode, abs(self.stride), -1 if self.stride < 0 else 1)
+
+    def tobytes(self):
+        return self.toImage().tobytes()
+
+    def transpose(self, method):
+        return self.toImage().transpose(method)
+
+    # the pixels, a band of rows at a time
+    def getdata(self):
+        rowsPerBand = max(1, MappedImage.BANDSIZE // abs(self.stride))
+        for top in range(0, self.height, rowsPerBand):
+            yield from self.crop((0, top, self.width, min(top + rowsPerBand, self.height))).toImage().getdata()
+
+    # an array of (height, width, channels), or (height, width) for L, on the mapping itself
+    # rows stored bottom up and channels stored backwards are reversed with negative strides, so nothing is copied
+    def toArray(self):
+        low, length = self.getExtent()
+        array = np.ndarray((self.height, self.width, self.pixelSize), np.uint8, self.buffer, low, (abs(self.stride), self.pixelSize, 1))
+        if self.stride < 0:
+            array = array[::-1]
+        return array[..., MappedImage.RAWMODES[self.rawmode]]
+
+    # for np.asarray
+    def __array__(self, dtype=None, copy=None):
+        array = self.toArray()
+        return array if dtype is None else array.astype(dtype)
+
+PNMMODES = {b'P5': 'L', b'P6': 'RGB'}
+
+# the header of a binary PPM (P6, RGB) or PGM (P5, L): the magic number, width, height, and maximum value,
+# separated by whitespace, with comments from # to the end of a line, then a single whitespace
+# return the mode, the size, and the offset of the data, or None if it isn't 8 bits per channel
+def readPNMHeader(buffer):
+    if buffer[:2] not in PNMMODES:
+        return None
+    fields, position = [], 2
+    while len(fields) < 3:
+        if position >= len(buffer):
+            return None
+        char = buffer[position:position+1]
+        if char == b'#':
+            position = buffer.find(b'\n', position)
+            if position == -1:
+                return None
+        elif char.isspace():
+            position += 1
+        else:
+            end = position
+            while end < len(buffer) and buffer[end:end+1].isdigit():
+                end += 1
+            if end == position:
+                return None
+            fields.append(int(buffer[position:end]))
+            position = end
+    width, height, maxValue = fields
+    if maxValue != 255:
+        return None
+    return PNMMODES[buffer[:2]], (width, height), position + 1
+
+BMPRAWMODES = {24: 'BGR', 32: 'BGRX'}
+
+# the headers of an uncompressed 24 or 32 bit BMP (see BMPWriter)
+# return the mode, the size, the offset of the top row, the stride, and the rawmode, or None if it is any other kind
+def readBMPHeader(buffer):
+    fileHeader, infoHeader = BMPWriter.FILEHEADER, BMPWriter.INFOHEADER
+    if len(buffer) < fileHeader.size + infoHeader.size or buffer[:2] != b'BM':
+        return None
+    magic, fileSize, reserved1, reserved2, offset = fileHeader.unpack_from(buffer)
+    headerSize, width, height, planes, bits, compression = infoHeader.unpack_from(buffer, fileHeader.size)[:6]
+    if headerSize < infoHeader.size or bits not in BMPRAWMODES or compression != 0:
+        return None
+
+    stride = (width * bits + 31) // 32 * 4
+    if height > 0:
+        offset, stride = offset + (height - 1) * stride, -stride
+    return 'RGB', (width, abs(height)), offset, stride, BMPRAWMODES[bits]
+
+# memory map an uncompressed image file (PPM, PGM, BMP, or NPY) as a MappedImage
+# return None for any other file, or one too short for its header
+def mapImage(fileName):
+    with open(fileName, 'rb') as inFile:
+        if os.fstat(inFile.fileno()).st_size == 0:
+            return None
+        buffer = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    layout = None
+    if buffer[:len(NPYMAGIC)] == NPYMAGIC:
+        with open(fileName, 'rb') as inFile:
+            mode, size, offset = readNPYHeader(inFile)
+        layout = mode, size, offset, size[0] * len(mode), mode
+    elif readPNMHeader(buffer) is not None:
+        mode, size, offset = readPNMHeader(buffer)
+        layout = mode, size, offset, size[0] * len(mode), mode
+    elif readBMPHeader(buffer) is not None:
+        layout = readBMPHeader(buffer)
+
+    if layout is not None:
+        image = MappedImage(buffer, *layout)
+        low, length = image.getExtent()
+        if image.width > 0 and image.height > 0 and low >= 0 and low + length <= len(buffer):
+            return image
+    buffer.close()
+    return None
+
+# make an uncompressed image file (PPM, PGM, NPY, or a top-down BMP as written by BMPWriter) height rows tall
+# in place, rewriting only its header and adding rows of 0s to the end of the file (or cutting them off),
+# and return a MappedImage on a writable mapping of it (see putRows)
+# return None if the file can't be changed in place: any other format, rows stored bottom up, or a header
+# that would change length (e.g. a PPM whose height gets another digit)
+def extendImage(fileName, height):
+    image = mapImage(fileName)
+    if image is None:
+        return None
+    with image:
+        if image.stride < 0:
+            return None
+        buffer = image.buffer
+        if buffer[:len(NPYMAGIC)] == NPYMAGIC:
+            header = makeNPYHeader(image.width, height, len(image.mode))
+        elif buffer[:2] in PNMMODES:
+            header = b'%s\n%d %d\n255\n' % (buffer[:2], image.width, height)
+        else:
+            header = bytearray(buffer[:image.offset])
+            fileHeader, infoHeader = BMPWriter.FILEHEADER, BMPWriter.INFOHEADER
+            fields = list(infoHeader.unpack_from(header, fileHeader.size))
+            fields[2], fields[6] = -height, image.stride * height
+            fileHeader.pack_into(header, 0, b'BM', image.offset + image.stride * height, 0, 0, image.offset)
+            infoHeader.pack_into(header, fileHeader.size, *fields)
+        if len(header) != image.offset:
+            return None
+
+    with open(fileName, 'r+b') as outFile:
+        outFile.write(header)
+        outFile.truncate(image.offset + image.stride * height)
+        buffer = mmap.mmap(outFile.fileno(), 0)
+    return MappedImage(buffer, image.mode, (image.width, height), image.offset, image.stride, image.rawmode)
+
+#######################
+#### OPEN AND SAVE ####
+#######################
+
+# the pixels of a PIL Image, copied once into memory, as a MappedImage on them
+# so that several decoders can share them, each reading them in place instead of converting the image again
+# images that are already mapped, or in modes a MappedImage can't hold, are returned as they are
+def shareImage(image):
+    if isinstance(image, MappedImage) or image.mode not in MappedImage.RAWMODES:
+        return image
+    width, height = image.size
+    return MappedImage(image.tobytes(), image.mode, image.size, 0, width * len(image.getbands()), image.mode)
+
+# an image in RGB, which is what the ColorCode decoder reads: an RGBA MappedImage skips its alpha
+# channel in place, without copying anything, and anything else in another mode (such as the palette
+# images that saveImage writes with palette) is converted
+def toRGB(image):
+    if image.mode == 'RGB':
+        return image
+    if isinstance(image, MappedImage):
+        if image.mode == 'RGBA':
+            return MappedImage(image.buffer, 'RGB', image.size, image.offset, image.stride, 'RGBX')
+        image = image.toImage()
+    return image.convert('RGB')
+
+# open an image file in any of the FORMATS, or anything else Pillow can open
+# palette images are converted to RGB, which is what the decoders expect
+# with mapped, uncompressed files are memory mapped (see mapImage), for decoding only
+def openImage(fileName, mapped=False):
+    if mapped:
+        image = mapImage(fileName)
+        if image is not None:
+            return image
+    if isNPY(fileName):
+        with open(fileName, 'rb') as inFile:
+            return readNPY(inFile)
+    image = Image.open(fileName)
+    if image.mode == 'P':
+        image = image.convert('RGB')
+    return image
+
+# a new, empty temporary file next to fileName, with the same extension so that it is written in the same format,
+# to write an image to and then replace fileName with; its name is unique, so two runs writing the same file
+# can't clobber each other's, and it gets the permissions a new file would (mkstemp makes it private)
+def tempImage(fileName):
+    directory, base = os.path.split(fileName)
+    fd, tempName = tempfile.mkstemp(dir=directory or '.', prefix='.' + os.path.splitext(base)[0] + '.', suffix=os.path.splitext(base)[1])
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tempName, 0o666 & ~umask)
+    return tempName
+
+# remove a temporary file after an error, if it is still there
+def removeTemp(tempName):
+    try:
+        os.unlink(tempName)
+    except OSError:
+        pass
+
+# save an image, in the format given by the file extension
+# (or by fileFormat, which is needed if fileName is an open file, for any format except NPY)
+# compressLevel (0 to 9) and optimize apply to PNG; palette saves PNG and BMP in P mode when
+# the image has at most 256 colors (otherwise it is saved as it is)
+# return the image that was saved
+def saveImage(image, fileName, compressLevel=None, optimize=False, palette=False, fileFormat=None):
+    if fileFormat is None:
+        fileFormat = getFormat(fileName)
+    if fileFormat == 'NPY':
+        with open(fileName, 'wb') as outFile:
+            writeNPY(image, outFile)
+        return image
+
+    if palette and fileFormat in ('PNG', 'BMP'):
+        image = toPalette(image) or image
+
+    options = {}
+    if fileFormat == 'PNG':
+        if compressLevel is not None:
+            options['compress_level'] = compressLevel
+        options['optimize'] = optimize
+
+    image.save(fileName, fileFormat, **options)
+    return image
+
+# an image from bytes in memory, in any of the FORMATS, or anything else Pillow can open
+def loadImage(data):
+    if data[:len(NPYMAGIC)] == NPYMAGIC:
+        return readNPY(io.BytesIO(data))
+    image = Image.open(io.BytesIO(data))
+    if image.mode == 'P':
+        image = image.convert('RGB')
+    return image
+
+# the size of an image from bytes in memory, as for loadImage, from its header, without decoding the pixels
+def sizeImage(data):
+    if data[:len(NPYMAGIC)] == NPYMAGIC:
+        return readNPYHeader(io.BytesIO(data))[1]
+    return Image.open(io.BytesIO(data)).size
+
+# the size of an image file, as for openImage, from its header, without reading the pixels
+def sizeFile(fileName):
+    if isNPY(fileName):
+        with open(fileName, 'rb') as inFile:
+            return readNPYHeader(inFile)[1]
+    with Image.open(fileName) as image:
+        return image.size
+
+# an image as bytes in memory, in one of the FORMATS, by name (see saveImage)
+def dumpImage(image, fileFormat='PNG', compressLevel=None, optimize=False, palette=False):
+    buffer = io.BytesIO()
+    if fileFormat == 'NPY':
+        writeNPY(image, buffer)
+    else:
+        saveImage(image, buffer, compressLevel, optimize, palette, fileFormat)
+    return buffer.getvalue()
+
+###############################
+#### STREAMING ROW WRITERS ####
+###############################
+
+# minimal 8-bit RGB writers that take one row of pixels at a time, as bytes, top to bottom
+# so that images can be written without ever holding more than a row in memory
+class RowWriter():
+
+    def __init__(self, fileName, width, height):
+        self.file = open(fileName, 'wb')
+        self.width, self.height = width, height
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeRow(self, row):
+        self.file.write(row)
+
+    def close(self):
+        self.file.close()
+
+# a PNG chunk is its length, type, data, and CRC of the type and data
+def makeChunk(chunkType, data):
+    return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data))
+
+# rows are compressed as they come in, and compressed data is written out
+# in IDAT chunks whenever enough of it has accumulated
+class PNGWriter(RowWriter):
+
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    CHUNKSIZE = 2**16
+
+    def __init__(self, fileName, width, height, compressLevel=None):
+        super().__init__(fileName, width, height)
+        self.compressor = zlib.compressobj(-1 if compressLevel is None else compressLevel)
+        self.buffer = b''
+
+        self.file.write(PNGWriter.SIGNATURE)
+        # width, height, bit depth 8, color type 2 (RGB), default compression, filter, interlace
+        self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def writeChunk(self, chunkType, data):
+        self.file.write(makeChunk(chunkType, data))
+
+    # compressed pixel data goes in IDAT chunks
+    def writeData(self, data):
+        self.writeChunk(b'IDAT', data)
+
+    # every row starts with a filter type byte, 0 (none)
+    def writeRow(self, row):
+        self.buffer += self.compressor.compress(b'\x00' + row)
+        if len(self.buffer) >= PNGWriter.CHUNKSIZE:
+            self.writeData(self.buffer)
+            self.buffer = b''
+
+    def close(self):
+        self.buffer += self.compressor.flush()
+        self.writeData(self.buffer)
+        self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+# binary PPM: a short text header, then the rows as they are
+class PPMWriter(RowWriter):
+
+    def __init__(self, fileName, width, height, compressLevel=None):
+        super().__init__(fileName, width, height)
+        self.file.write('P6\n{} {}\n255\n'.format(width, height).encode('ascii'))
+
+# 24-bit BMP: a file header and an info header, then the rows
+# the height is stored as negative, meaning the rows go top to bottom, so they can be written in order
+# every row is stored as BGR and padded to a multiple of 4 bytes
+class BMPWriter(RowWriter):
+
+    FILEHEADER = struct.Struct('<2sIHHI')
+    INFOHEADER = struct.Struct('<IiiHHIIiiII')
+
+    def __init__(self, fileName, width, height, compressLevel=None):
+        super().__init__(fileName, width, height)
+        self.padding = bytes(-3*width % 4)
+        imageSize = (3*width + len(self.padding)) * height
+        offset = BMPWriter.FILEHEADER.size + BMPWriter.INFOHEADER.size
+
+        self.file.write(BMPWriter.FILEHEADER.pack(b'BM', offset + imageSize, 0, 0, offset))
+        # header size, width, -height, 1 plane, 24 bits, no compression, image size, 72 dpi, no palette
+        self.file.write(BMPWriter.INFOHEADER.pack(BMPWriter.INFOHEADER.size, width, -height, 1, 24, 0, imageSize, 2835, 2835, 0, 0))
+
+    def writeRow(self, row):
+        bgr = bytearray(len(row))
+        bgr[0::3], bgr[1::3], bgr[2::3] = row[2::3], row[1::3], row[0::3]
+        self.file.write(bgr + self.padding)
+
+# NPY: the header, then the rows as they are
+class NPYWriter(RowWriter):
+
+    def __init__(self, fileName, width, height, compressLevel=None):
+        super().__init__(fileName, width, height)
+        self.file.write(makeNPYHeader(width, height, 3))
+
+WRITERS = {
+    'PNG': PNGWriter,
+    'PPM': PPMWriter,
+    'BMP': BMPWriter,
+    'NPY': NPYWriter,
+}
+
+# the row writer for a file name, from its extension
+def getWriter(fileName, width, height, compressLevel=None):
+    fileFormat = getFormat(fileName)
+    if fileFormat not in WRITERS:
+        raise Exception('Streaming mode can only write {} files'.format(', '.join(sorted(WRITERS))))
+    return WRITERS[fileFormat](fileName, width, height, compressLevel)
+
+###########################
+#### MULTI-FRAME FILES ####
+###########################
+
+# files holding a sequence of images, for payloads too large for one: an animated PNG (APNG),
+# or a multi-page TIFF; every frame is a whole image, so each one can be encoded or decoded on its own
+# frames are written one at a time, as they are made, and read one at a time, when they are asked for,
+# so only one frame is ever in memory (Pillow's own APNG writer keeps them all, and its reader decodes
+# every frame before the one asked for)
+
+# an APNG is a PNG with an acTL chunk after IHDR, and an fcTL chunk before the data of every frame
+# the first frame is the image that viewers without APNG support show, so its data is in IDAT chunks,
+# and every later frame's is in fdAT chunks, which start with a sequence number, shared with fcTL
+class APNGWriter(PNGWriter):
+
+    # sequence number, width, height, x and y offsets, delay numerator and denominator, dispose and blend operations
+    FCTL = struct.Struct('>IIIIIHHBB')
+
+    # nFrames has to be known up front, and exactly that many frames written
+    def __init__(self, fileName, width, height, nFrames, compressLevel=None):
+        super().__init__(fileName, width, height, compressLevel)
+        self.compressLevel = compressLevel
+        self.frame, self.sequence = 0, 0
+        # number of frames, number of plays (0 for forever)
+        self.writeChunk(b'acTL', struct.pack('>II', nFrames, 0))
+
+    def writeData(self, data):
+        if self.frame == 0:
+            self.writeChunk(b'IDAT', data)
+        else:
+            self.writeChunk(b'fdAT', struct.pack('>I', self.sequence) + data)
+            self.sequence += 1
+
+    # every frame covers the whole image, shows for a second, and replaces the one before
+    # the data of every frame is a zlib stream of its own
+    def writeFrame(self, image):
+        if image.size != (self.width, self.height):
+            raise Exception('Every frame has to be {} x {} px'.format(self.width, self.height))
+        self.writeChunk(b'fcTL', APNGWriter.FCTL.pack(self.sequence, self.width, self.height, 0, 0, 1, 1, 0, 0))
+        self.sequence += 1
+
+        data = (image if image.mode == 'RGB' else image.convert('RGB')).tobytes()
+        rowSize = 3 * self.width
+        for top in range(0, len(data), rowSize):
+            self.writeRow(data[top:top + rowSize])
+        self.buffer += self.compressor.flush()
+        self.writeData(self.buffer)
+        self.buffer = b''
+        self.compressor = zlib.compressobj(-1 if self.compressLevel is None else self.compressLevel)
+        self.frame += 1
+
+    def close(self):
+        self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+# a multi-page TIFF, through Pillow's writer for adding pages to a file one at a time
+# pages are deflate compressed (if Pillow has libtiff), or not at all for compressLevel 0
+class TIFFWriter():
+
+    def __init__(self, fileName, width, height, nFrames, compressLevel=None):
+        self.file = TiffImagePlugin.AppendingTiffWriter(fileName, new=True)
+        self.options = {}
+        if compressLevel != 0 and features.check('libtiff'):
+            self.options['compression'] = 'tiff_adobe_deflate'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writeFrame(self, image):
+        image.save(self.file, 'TIFF', **self.options)
+        self.file.newFrame()
+
+    def close(self):
+        self.file.close()
+
+FRAMEWRITERS = {
+    'PNG' : APNGWriter,
+    'TIFF': TIFFWriter,
+}
+
+# the frame writer for a file name, from its extension
+def getFrameWriter(fileName, width, height, nFrames, compressLevel=None):
+    fileFormat = getFormat(fileName)
+    if fileFormat not in FRAMEWRITERS:
+        raise Exception('Frames can only be written to {} files'.format(', '.join(sorted(FRAMEWRITERS))))
+    return FRAMEWRITERS[fileFormat](fileName, width, height, nFrames, compressLevel)
+
+# the frames of an open PNG file, from its chunk headers alone, without reading any pixel data
+# return the IHDR data, any other chunks the pixel data needs (PLTE, tRNS), and for every frame,
+# its size and the (position, length) of each part of its compressed data in the file
+# a PNG that isn't animated has a single frame; in an APNG, an IDAT before the first fcTL isn't a frame
+def indexPNG(inFile):
+    if inFile.read(len(PNGWriter.SIGNATURE)) != PNGWriter.SIGNATURE:
+        raise Exception('Not a PNG file')
+    header, chunks, frames, animated = None, b'', [], False
+    while True:
+        chunkHeader = inFile.read(8)
+        if len(chunkHeader) < 8:
+            break
+        length, chunkType = struct.unpack('>I4s', chunkHeader)
+        position = inFile.tell()
+        if chunkType == b'IHDR':
+            header = inFile.read(length)
+        elif chunkType in (b'PLTE', b'tRNS'):
+            chunks += makeChunk(chunkType, inFile.read(length))
+        elif chunkType == b'acTL':
+            animated = True
+        elif chunkType == b'fcTL':
+            sequence, width, height = struct.unpack('>III', inFile.read(12))
+            frames.append(((width, height), []))
+        elif chunkType == b'IDAT':
+            if not animated and not frames:
+                frames.append((struct.unpack('>II', header[:8]), []))
+            if frames:
+                frames[-1][1].append((position, length))
+        elif chunkType == b'fdAT':
+            frames[-1][1].append((position + 4, length - 4))
+        elif chunkType == b'IEND':
+            break
+        inFile.seek(position + length + 4)
+    return header, chunks, frames
+
+# the frames of an image file, read one at a time, in any order
+# an APNG (or any PNG) is indexed up front (see indexPNG), and each frame is read by putting its
+# compressed data, as it is, into a single frame PNG in memory, which Pillow then decodes
+# anything else is left to Pillow, which seeks straight to a page of a TIFF
+# frames are read as they are stored: an APNG frame that only covers part of the image is just that part
+# (a file with only one image, e.g. a PPM, has one frame)
+class FrameReader():
+
+    def __init__(self, fileName):
+        self.file, self.image = None, None
+        with open(fileName, 'rb') as inFile:
+            isPNG = inFile.read(len(PNGWriter.SIGNATURE)) == PNGWriter.SIGNATURE
+        if isPNG:
+            self.file = open(fileName, 'rb')
+            self.header, self.chunks, self.frames = indexPNG(self.file)
+            self.nFrames = len(self.frames)
+        elif isNPY(fileName):
+            self.image = openImage(fileName)
+            self.nFrames = 1
+        else:
+            self.image = Image.open(fileName)
+            self.nFrames = getattr(self.image, 'n_frames', 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.nFrames
+
+    # the size of a frame, without decoding it
+    def getSize(self, index):
+        if self.file is not None:
+            return self.frames[index][0]
+        self.image.seek(index)
+        return self.image.size
+
+    # a frame, as a PIL Image, with palette images converted to RGB, as in openImage
+    def getFrame(self, index):
+        if not 0 <= index < self.nFrames:
+            raise Exception('No frame {}: there are {}'.format(index, self.nFrames))
+        if self.file is not None:
+            size, parts = self.frames[index]
+            data = bytearray()
+            for position, length in parts:
+                self.file.seek(position)
+                data += self.file.read(length)
+            header = struct.pack('>II', *size) + self.header[8:]
+            return loadImage(PNGWriter.SIGNATURE + makeChunk(b'IHDR', header) + self.chunks
+                + makeChunk(b'IDAT', bytes(data)) + makeChunk(b'IEND', b''))
+        self.image.seek(index)
+        frame = self.image.copy()
+        return frame.convert('RGB') if frame.mode == 'P' else frame
+
+    def __iter__(self):
+        for index in range(self.nFrames):
+            yield self.getFrame(index)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.image is not None:
+            self.image.close()
+
+# the number of frames of an image file (see FrameReader)
+def countFrames(fileName):
+    with FrameReader(fileName) as reader:
+        return len(reader)
+
+# whether an image file has more than one frame
+# only APNG and TIFF files are checked, so other files are never opened
+def hasFrames(fileName):
+    if getFormat(fileName) not in FRAMEWRITERS:
+        return False
+    try:
+        return countFrames(fileName) > 1
+    except OSError:
+        return False
@@ -0,0 +1,126 @@
+import argparse
+from PIL import Image
+
+import colorcode
+import compression
+import imagefile
+import profiling
+import steganography
+
+# two messages in one image: one in the colors, as with colorcode.py, and one in the LSBs, as with steganography.py
+# (see Combining the two scripts in the README)
+# instead of saving the ColorCode image, opening it again to embed the second message, and saving it again,
+# the grid is built and the second message embedded in memory, and the image is saved once
+# both messages are then decoded from a single load of the image, which both decoders share
+# the colors only use the upper 7 bits of each channel, so the second message gets 1 bit per channel,
+# and the first can't be dense (or compressed, which implies dense), since that uses all 8
+
+###########################
+#### LIBRARY FUNCTIONS ####
+###########################
+
+# encode message into the colors and secret into the LSBs of a single PIL Image
+# block, ncols, nrows, and header are as for colorcode.encode, and compress compresses the secret
+# the grid has to be large enough for the secret too, which a larger block size gives
+@profiling.profiled
+def encode(message, secret, block=(1, 1), ncols=None, nrows=None, header=True, compress=None, jobs=1):
+    colorCoder = colorcode.ColorCode(message, block, ncols, nrows, header, jobs=jobs)
+    stegCoder = steganography.SteganographyCode(colorCoder.toImage(), secret, True, 1, compress, jobs)
+    if stegCoder.size > stegCoder.capacity():
+        raise Exception('Image can hold {} characters of the second message, which has {}; use a larger block size'.format(
+            stegCoder.capacity(), stegCoder.size
+        ))
+    return stegCoder.toImage()
+
+# decode both messages from a PIL Image (or array, or imagefile.MappedImage), as (message, secret)
+# the pixels are loaded once, and both decoders read them in place (see imagefile.shareImage)
+# ncols, nrows, and detect are as for colorcode.decode, and length as for steganography.extract
+@profiling.profiled
+def decode(image, ncols=None, nrows=None, detect=False, length=None, jobs=1):
+    if not isinstance(image, (Image.Image, imagefile.MappedImage)):
+        image = Image.fromarray(image)
+    with profiling.stage('load'):
+        image = imagefile.shareImage(image)
+    message = colorcode.Decode(image, ncols, nrows, detect, jobs).getMessage()
+    secret = steganography.SteganographyCode(image, jobs=jobs).decode(length)
+    return message, secret
+
+###############################
+#### MAIN ARGPARSE AND RUN ####
+###############################
+
+# in encode mode
+# - provide an input TEXT file (or - for stdin) for the colors, and a SECRET text file for the LSBs
+# - provide an output file or accept that default of image.png
+# - the block size, dimensions, --noheader, --level, and --optimize are as for colorcode.py
+# - specify --compress to compress the secret
+# - the secret needs 8 channels per character, so the grid usually needs a block size larger than 1 x 1
+
+# in decode mode
+# - specify --decode
+# - provide an input IMAGE file, and the dimensions if it has no header, as for colorcode.py
+# - specify --length to decode only part of the secret
+
+# in either mode
+# - specify --jobs N and --profile as for colorcode.py
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('-i' , '--inputfile' , dest='INPUT'   , default='-'        ,                    help='input filename (or image to decode) or - for raw input')
+    parser.add_argument('-m' , '--secret'    , dest='SECRET'  , default=None       ,                    help='filename of the message for the LSBs')
+    parser.add_argument('-o' , '--outputfile', dest='OUTPUT'  , default='image.png',                    help='output filename'                  )
+    parser.add_argument('-nr', '--nrows'     , dest='NROWS'   , default=None       ,          type=int, help='number of rows'                   )
+    parser.add_argument('-nc', '--ncols'     , dest='NCOLS'   , default=None       ,          type=int, help='number of columns'                )
+    parser.add_argument('-b' , '--blocksize' , dest='BLOCK'   , default=[1, 1]     , nargs=2, type=int, help='block size X Y to scale up'       )
+    parser.add_argument('-d' , '--decode'    , dest='DECODE'  , action='store_true',                    help='whether to decode an image file'  )
+    parser.add_argument('-l' , '--length'    , dest='LENGTH'  , default=None       ,          type=int, help='number of characters of the secret to decode')
+    parser.add_argument(       '--noheader'  , dest='HEADER'  , action='store_false',                   help='whether to leave out the color header')
+    parser.add_argument(       '--nodetect'  , dest='DETECT'  , action='store_false',                   help='whether to assume 1 x 1 px blocks' )
+    parser.add_argument(       '--compress'  , dest='COMPRESS', default=None       , choices=compression.CODECS, help='codec to compress the secret with')
+    parser.add_argument(       '--level'     , dest='LEVEL'   , default=None       , type=int, choices=range(10), help='PNG compression level, 0 to 9'   )
+    parser.add_argument(       '--optimize'  , dest='OPTIMIZE', action='store_true',                    help='whether to make the PNG as small as possible')
+    parser.add_argument('-j' , '--jobs'      , dest='JOBS'    , default=1          ,          type=int, help='number of threads, 0 for all CPUs')
+    parser.add_argument(       '--profile'   , dest='PROFILE' , default=None       , nargs='?', const='table', choices=profiling.FORMATS, help='print the time and memory of each stage')
+    args = parser.parse_args(argv)
+
+    with profiling.profile(args.PROFILE):
+        if args.DECODE:
+            decodeMain(args)
+        else:
+            encodeMain(args)
+
+# encode mode: read both messages and write the image
+def encodeMain(args):
+    if args.SECRET is None:
+        raise Exception('No secret message file specified')
+    message = colorcode.readMessage(args.INPUT)
+    secret = steganography.readMessage(args.SECRET)
+
+    image = encode(message, secret, args.BLOCK, args.NCOLS, args.NROWS, args.HEADER, args.COMPRESS, args.JOBS)
+    try:
+        with profiling.stage('save'):
+            imagefile.saveImage(image, args.OUTPUT, args.LEVEL, args.OPTIMIZE)
+    except:
+        raise Exception('Error when trying to write to {}'.format(colorcode.bold(args.OUTPUT)))
+
+    colorcode.printSummary(image.size, args.OUTPUT, args.BLOCK, args.HEADER)
+    print('Decode both messages in {} with : {}'.format(
+        colorcode.bold(args.OUTPUT),
+        colorcode.colorize('python layers.py --decode --inputfile {}'.format(args.OUTPUT), 'pink')
+    ))
+
+# decode mode: read the image once and print both messages
+def decodeMain(args):
+    try:
+        with profiling.stage('open'):
+            image = imagefile.openImage(args.INPUT, mapped=True)
+    except:
+        raise Exception('Error when trying to open image file {}'.format(colorcode.bold(args.INPUT)))
+    print('Attempting to decode {}:\n'.format(colorcode.bold(args.INPUT)))
+
+    message, secret = decode(image, args.NCOLS, args.NROWS, args.DETECT, args.LENGTH, args.JOBS)
+    print('{}: {}'.format(colorcode.bold('Colors'), colorcode.colorize(message, 'blue')))
+    print('{}: {}'.format(colorcode.bold('LSBs'  ), colorcode.colorize(secret , 'blue')))
+
+if __name__ == '__main__':
+    main()
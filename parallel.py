@@ -0,0 +1,40 @@
+import concurrent.futures
+import math
+import os
+
+# splitting the work on a large image across threads, for both scripts
+# the work is split into bands (of rows, channels, or bytes), which are independent and in order,
+# so each band is done on its own and the results are put back together in order
+# the heavy lifting in every band is done by NumPy, which releases the GIL for operations on
+# large arrays, so the threads really run in parallel, and share the image without copying it
+# with 1 job (the default everywhere), there is a single band, done in the calling thread,
+# so the serial and parallel paths are the same code and give the same output
+
+# number of bands per thread, so that a thread that finishes early can take another band
+BANDSPERJOB = 4
+
+# smallest band worth handing to a thread, in bytes
+MINBANDSIZE = 2**18
+
+# the number of threads to use: jobs, or every CPU for None or 0
+def getJobs(jobs):
+    return jobs or os.cpu_count() or 1
+
+# split start to end into bands of about equal size, as (start, end) pairs
+# every band but the last starts and ends on a multiple of align after start
+# itemSize is the number of bytes of each unit, to keep bands to at least MINBANDSIZE bytes
+def getBands(start, end, jobs=1, align=1, itemSize=1):
+    nBands = 1
+    if getJobs(jobs) > 1:
+        nBands = max(min(getJobs(jobs) * BANDSPERJOB, math.ceil((end - start) * itemSize / MINBANDSIZE)), 1)
+    bandSize = align * max(math.ceil((end - start) / nBands / align), 1)
+    return [(idx, min(idx + bandSize, end)) for idx in range(start, end, bandSize)] or [(start, end)]
+
+# call function(bandStart, bandEnd) for every band from start to end (see getBands), in jobs threads
+# and return the list of results, in order
+def mapBands(function, start, end, jobs=1, align=1, itemSize=1):
+    bands = getBands(start, end, jobs, align, itemSize)
+    if len(bands) == 1:
+        return [function(*bands[0])]
+    with concurrent.futures.ThreadPoolExecutor(min(getJobs(jobs), len(bands))) as pool:
+        return list(pool.map(lambda band: function(*band), bands))
@@ -0,0 +1,187 @@
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+# per-stage timing and memory for both scripts
+# a stage records its wall time, CPU time, and (if tracemalloc is tracing) its peak memory,
+# i.e. the most memory allocated during the stage on top of what was allocated when it started
+# events are only recorded while profiling is enabled (--profile), and are passed to any hooks
+# otherwise, a stage costs a single check
+# stages can run in several threads at once: each thread nests its own stages, but tracemalloc
+# counts the whole process, so a peak includes what other threads allocated during the stage
+
+###############
+#### STATE ####
+###############
+
+# whether profiling is enabled, and the events recorded since it was
+enabled = False
+events  = []
+
+# functions to call with every event, for library callers
+hooks = []
+
+# the stages currently running in each thread, innermost last (see getStack)
+local = threading.local()
+
+# the stages currently tracking memory, in every thread, and a lock for them and for tracemalloc's peak
+tracking = set()
+trackingLock = threading.Lock()
+
+# perf_counter when profiling was enabled, so that events have a start time relative to it
+origin = 0.
+
+# whether tracemalloc was started by enable, so that disable knows to stop it
+startedTracing = False
+
+# add or remove a hook: a function taking an event, which is a dictionary with
+# stage (name), depth (nesting level), start, wall, cpu (seconds), peak (bytes, or None), and any extra info
+# hooks are called whether or not profiling is enabled
+def addHook(hook):
+    hooks.append(hook)
+
+def removeHook(hook):
+    hooks.remove(hook)
+
+# the stack of stages running in this thread
+def getStack():
+    if not hasattr(local, 'stack'):
+        local.stack = []
+    return local.stack
+
+# start recording events, and start tracemalloc if memory is True
+def enable(memory=True):
+    global enabled, origin, startedTracing
+    enabled = True
+    origin = time.perf_counter()
+    events.clear()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        startedTracing = True
+
+# stop recording events, and stop tracemalloc if enable started it
+def disable():
+    global enabled, startedTracing
+    enabled = False
+    if startedTracing:
+        tracemalloc.stop()
+        startedTracing = False
+
+################
+#### STAGES ####
+################
+
+class Stage():
+
+    # a stage with a name and any extra info to put in its event
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    # tracemalloc only keeps one peak, so before resetting it for this stage,
+    # fold it into the peaks of every stage tracking memory, enclosing this one or in other threads
+    # (resetting needs Python 3.9, so before that, there is no peak)
+    def __enter__(self):
+        self.memory = None
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            with trackingLock:
+                current, peak = tracemalloc.get_traced_memory()
+                for other in tracking:
+                    other.peak = max(other.peak, peak)
+                tracemalloc.reset_peak()
+                self.memory = self.peak = current
+                tracking.add(self)
+        self.stack = getStack()
+        self.stack.append(self)
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    # make the event, with the peak since the stage started
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        self.stack.pop()
+
+        peak = None
+        if self.memory is not None:
+            with trackingLock:
+                tracking.discard(self)
+                if tracemalloc.is_tracing():
+                    self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                    peak = self.peak - self.memory
+
+        event = {'stage': self.name, 'depth': len(self.stack), 'start': self.start - origin, 'wall': wall, 'cpu': cpu, 'peak': peak}
+        event.update(self.info)
+        if enabled:
+            events.append(event)
+        for hook in hooks:
+            hook(event)
+
+NULLSTAGE = contextlib.nullcontext()
+
+# a context manager timing the code inside it as a stage
+# with nothing listening, it does nothing
+def stage(name, **info):
+    if not enabled and not hooks:
+        return NULLSTAGE
+    return Stage(name, info)
+
+# a decorator timing every call of a function as a stage with the function's name
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled and not hooks:
+            return function(*args, **kwargs)
+        with Stage(function.__name__, {}):
+            return function(*args, **kwargs)
+    return wrapper
+
+#################
+#### REPORTS ####
+#################
+
+FORMATS = ('table', 'json', 'jsonl')
+
+# write events in one of FORMATS, in the order the stages started
+# table is for people, with nested stages indented; json is a list, and jsonl is one event per line
+def report(events, format='table', file=None):
+    file = sys.stderr if file is None else file
+    events = sorted(events, key=lambda event: event['start'])
+
+    if format == 'json':
+        json.dump(events, file, indent=1)
+        print(file=file)
+    elif format == 'jsonl':
+        for event in events:
+            print(json.dumps(event), file=file)
+    else:
+        print('{:<32} {:>10} {:>10} {:>10}'.format('stage', 'wall ms', 'cpu ms', 'peak MB'), file=file)
+        for event in events:
+            print('{:<32} {:>10.2f} {:>10.2f} {:>10}'.format(
+                '  ' * event['depth'] + event['stage'],
+                1000 * event['wall'],
+                1000 * event['cpu'],
+                '-' if event['peak'] is None else '{:.2f}'.format(event['peak'] / 10**6),
+            ), file=file)
+
+# a context manager for the command line: if format is one of FORMATS,
+# profile everything inside it as the stage total, and report it at the end
+# with format None, it does nothing
+@contextlib.contextmanager
+def profile(format=None, file=None):
+    if format is None:
+        yield
+        return
+
+    enable()
+    try:
+        with stage('total'):
+            yield
+    finally:
+        disable()
+        report(events, format, file)
@@ -1,7 +1,23 @@
 import argparse
+import codecs
+import concurrent.futures
 import math
+import operator
+import os
+import struct
+import zlib
 from PIL import Image
-import itertools
+
+import compression
+import imagefile
+import parallel
+import profiling
+
+# NumPy is optional; without it, the pure Python paths are used
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ########################
 #### PRETTY PRINTER ####
@@ -32,151 +48,707 @@ class SteganographyCode():
     NBITS = 8
     NCHAN = 3
 
-    # initialize with parsed arguments
-    # args should have INPUT, DECODE, and possibly MESSAGE
-    def __init__(self, args):
-
-        self.args = args
-        
-        # get the input image
-        if args.INPUT is None:
-            raise Exception('No image file specified')
+    # number of channels to decode at a time
+    STRIPSIZE = 2**16
+
+    # header, encoded before the message: magic, version, flags, and message length
+    # the header always takes up 1 bit per channel
+    # the lowest 2 bits of the flags are the number of bits per channel for the message, minus 1
+    # the next 2 bits are the number of the codec the message is compressed with (see compression.py)
+    # and then the length is the compressed length
+    MAGIC      = b'\x0eSG'
+    VERSION    = 1
+    HEADER     = struct.Struct('>3sBBI')
+    HEADERBITS = NBITS * HEADER.size
+    DEPTHMASK  = 0x03
+    MAXDEPTH   = 4
+    CODECSHIFT = 2
+    CODECMASK  = 0x0C
+
+    # initialize with a PIL Image (or an array, which is converted to one)
+    # or, for decoding, an imagefile.MappedImage
+    # and, for encoding, the message (str, or bytes, which are taken as Latin-1)
+    # if header is True, the message is prefixed with the header, so that the decoder knows
+    # exactly how long it is, instead of stopping at the first NULL character
+    # depth is the number of low bits of each channel used for the message, from 1 to 4 (needs a header if not 1)
+    # if compress is a codec name (see compression.py), the message is compressed first (needs a header),
+    # as bytes or as UTF-8 if it is a str, and decodes as UTF-8, as for colorcode.py
+    # jobs is the number of threads to encode or decode in (see parallel.py), which gives the same result
+    # no files are read or written here, see main for the command line version
+    def __init__(self, image, message=None, header=True, depth=1, compress=None, jobs=1):
+        self.jobs = jobs
+
+        if not isinstance(image, (Image.Image, imagefile.MappedImage)):
+            image = Image.fromarray(image)
+        self.image = image
+        self.header = header
+
+        if depth not in range(1, SteganographyCode.MAXDEPTH+1):
+            raise Exception('Depth must be from 1 to {}'.format(SteganographyCode.MAXDEPTH))
+        if depth != 1 and not header:
+            raise Exception('Depths other than 1 require a header')
+        if compress is not None and not header:
+            raise Exception('Compression requires a header')
+        self.depth = depth
+
+        self.message = message.decode('latin-1') if isinstance(message, bytes) else message
+
+        # what actually gets encoded
+        # size is the number of characters after the header
+        if message is not None:
+            self.payload = self.message
+            if compress is not None:
+                if isinstance(message, str):
+                    message = message.encode('utf-8')
+                with profiling.stage('compress', codec=compress):
+                    self.payload = compression.compress(message, compress).decode('latin-1')
+            self.size = len(self.payload)
+            if header:
+                flags = (depth-1) | compression.codecNumber(compress) << SteganographyCode.CODECSHIFT
+                self.payload = SteganographyCode.makeHeader(self.size, flags).decode('latin-1') + self.payload
+
+    # make the header for a message of the given length
+    # static function (doesn't take self)
+    def makeHeader(length, flags=0):
+        return SteganographyCode.HEADER.pack(SteganographyCode.MAGIC, SteganographyCode.VERSION, flags, length)
+
+    # number of channels at the start of the image that hold the header, at 1 bit per channel
+    def headerBits(self):
+        return SteganographyCode.HEADERBITS if self.header else 0
+
+    # number of characters the image can hold, not counting the header
+    # only depends on the image size, so the pixels don't need to be read
+    def capacity(self):
+        return SteganographyCode.sizeCapacity(self.image.size, self.depth, self.header)
+
+    # number of characters an image of size (width, height) can hold, not counting the header
+    # static function (doesn't take self)
+    def sizeCapacity(size, depth=1, header=True):
+        width, height = size
+        channels = width*height*SteganographyCode.NCHAN - (SteganographyCode.HEADERBITS if header else 0)
+        return max(channels*depth//SteganographyCode.NBITS, 0)
+
+    # the byte of a character, for its bits
+    # a character above 255 has more than NBITS bits, and only its highest NBITS are used
+    # static function (doesn't take self)
+    def toByte(char):
+        code = ord(char)
+        return code >> max(code.bit_length() - SteganographyCode.NBITS, 0)
+
+    # the bits of data (bytes), most significant first, grouped depth at a time into values, as bytes
+    # (padding the last group with 0s), e.g. b'A', depth 2 --> 01 00 00 01 --> 1, 0, 0, 1
+    # for depths that divide NBITS, every byte maps to the same values every time, so a table does it
+    # static function (doesn't take self)
+    def toValues(data, depth):
+        mask = (1 << depth) - 1
+        if SteganographyCode.NBITS % depth == 0:
+            shifts = range(SteganographyCode.NBITS - depth, -1, -depth)
+            table = [bytes((byte >> shift) & mask for shift in shifts) for byte in range(256)]
+            return b''.join(map(table.__getitem__, data))
+        bits = ''.join(map('{:08b}'.format, data))
+        bits += '0' * (-len(bits) % depth)
+        return bytes(int(bits[idx:idx+depth], 2) for idx in range(0, len(bits), depth))
+
+    # NumPy can only be used if it is installed, if the image is RGB(A),
+    # and if every character of the message fits in NBITS bits
+    def useNumpy(self):
+        if np is None or self.image.mode not in ('RGB', 'RGBA'):
+            return False
         try:
-            self.image = Image.open(args.INPUT)
-            print('Opening {}'.format(bold(self.args.INPUT)))
-        except:
-            raise Exception('Error when trying to open image file {}'.format(bold(self.args.INPUT)))
-
-        # get the input message
-        if not args.DECODE:
-            if args.MESSAGE == '-':
-                self.message = input('{}: {}'.format(bold('Enter message here'), colorize('', 'blue', False)))
-                print('\033[m', end='')
-            else:
-                try:
-                    self.message = open(args.MESSAGE).read()
-                    print('Reading text from {}'.format(bold(args.MESSAGE)))
-                except:
-                    raise Exception('Error reading from {}'.format(args.MESSAGE))
-
-    # given a letter and a bit number n,
-    # return the nth bit (from the left)
-    # e.g. 'A', 1 --> 01000001 --> 1
-    def getBit(letter, n):
-        # 'A' --> 65
-        AsciiCode = ord(letter)
-
-        # 65 --> '0b1000001' --> '01000001'
-        binStr = str(bin(AsciiCode))[2:].rjust(SteganographyCode.NBITS, '0')
-
-        # int of nth bit
-        return int(binStr[n])
+            self.payload.encode('latin-1')
+        except UnicodeEncodeError:
+            return False
+        return True
 
     # do the encoding step
+    @profiling.profiled
     def encode(self):
-
-        # get the data and turn it into lists so that it can be modified
-        data = [list(tup) for tup in list(self.image.getdata())]
-
-        # initialize the message bits and make sure the message can fit
-        bits = [0] * (SteganographyCode.NBITS * len(self.message))
-
-        print('Image can hold {} characters, message has {}: '.format(
-            bold(len(data)*SteganographyCode.NCHAN//8),
-            bold(len(self.message))
-        ), end='')
-        if len(bits) > len(data)*SteganographyCode.NCHAN:
-            print(colorize('Message too large', 'red'))
+        if self.useNumpy():
+            self.encodeNumpy()
+            return
+
+        # get the channels as a bytearray so that they can be modified
+        with profiling.stage('tobytes'):
+            channels = bytearray((self.image if self.image.mode == 'RGB' else self.image.convert('RGB')).tobytes())
+
+        # the value to add to each channel
+        # the header bits are 1 per channel; after that, group the bits depth at a time
+        # and interpret each group as an integer in base 2 (see toValues)
+        # then make sure the message can fit
+        payload = bytes(SteganographyCode.toByte(char) for char in self.payload)
+        nHeaderBytes = self.headerBits() // SteganographyCode.NBITS
+        header = SteganographyCode.toValues(payload[:nHeaderBytes], 1)
+        values = SteganographyCode.toValues(payload[nHeaderBytes:], self.depth)
+
+        start, end = len(header), len(header) + len(values)
+        if end > len(channels):
             raise Exception('Image is not big enough to hold the whole message')
-        else:
-            print(colorize('OK', 'green'))
-
-        # fill in the bits
-        # i indexes the letter, so skip forward by NBITS each letter
-        # j indexes the bit, get the bit with the getBit function
-        for i, letter in enumerate(self.message):
-            for j in range(SteganographyCode.NBITS):
-                bits[SteganographyCode.NBITS * i + j] = SteganographyCode.getBit(letter, j)
 
         # set all the LSBs in the actual image to 0
         # in a colorcode image, this step doesn't do anything
         # but in a normal image, this step ensures that junk
         # doesn't get decoded
-        for i, triplet in enumerate(data):
-            data[i] = [j-1 if j%2 == 1 else j for j in triplet]
-
-        # group the bits into triplets to get a pixel number (with i//3)
-        # which channel the bit is within the pixel is i%3 (0, 1, 2)
-        # add 1 to the channel if the bit to be set is 1 (all LSBs are 0, before)
-        for i, bit in enumerate(bits):
-            pixelNumber = i//3
-            channelNumber = i%3
-            if bit:
-                data[pixelNumber][channelNumber] += 1
-
-        # image likes lists of tuples
-        self.newData = [tuple(i) for i in data]
-
-    # write to a new image file
-    def write(self):
+        # then OR the header bits into the first channels, and after the header,
+        # set the lowest depth bits of the channels to 0 and OR the values in
+        mask = (1 << self.depth) - 1
+        channels = channels.translate(bytes(channel & 0xFE for channel in range(256)))
+        channels[:start] = bytes(map(operator.or_, channels[:start], header))
+        cleared = channels[start:end].translate(bytes(channel & ~mask for channel in range(256)))
+        channels[start:end] = bytes(map(operator.or_, cleared, values))
+
+        self.newData = channels
+
+    # vectorized version of encode, producing the same pixels
+    # unpackbits gives the bits of every character, most significant first
+    # the flattened channel view is in the same order as the bits: R, G, B of pixel 0, then pixel 1, ...
+    # so clear all the LSBs, then OR the header bits into the first channels
+    # after the header, the bits are grouped depth at a time into values (see getValues),
+    # and the lowest depth bits of the next channels are cleared and replaced by the values
+    # every channel only depends on its own value, so bands of channels are done in jobs threads (see parallel.py)
+    # (an RGBA image loses its alpha channel, as in the pure Python path)
+    @profiling.profiled
+    def encodeNumpy(self):
+        with profiling.stage('asarray'):
+            pixels = np.array(self.image if self.image.mode == 'RGB' else self.image.convert('RGB'), dtype=np.uint8)
+        channels = pixels.reshape(-1)
+
+        payload = np.frombuffer(self.payload.encode('latin-1'), dtype=np.uint8)
+        nHeaderBits = self.headerBits()
+        headerBits = np.unpackbits(payload[:nHeaderBits // SteganographyCode.NBITS])
+        message = payload[nHeaderBits // SteganographyCode.NBITS:]
+
+        end = nHeaderBits + math.ceil(message.size * SteganographyCode.NBITS / self.depth)
+        if end > channels.size:
+            raise Exception('Image is not big enough to hold the whole message')
+
+        mask = (1 << self.depth) - 1
+
+        def encodeBand(start, stop):
+            band = channels[start:stop]
+            band &= 0xFE
+            header = headerBits[start:stop]
+            band[:header.size] |= header
+            first, last = max(start, nHeaderBits), min(stop, end)
+            if first < last:
+                band[first-start:last-start] &= 0xFF ^ mask
+                band[first-start:last-start] |= self.getValues(message, first - nHeaderBits, last - nHeaderBits)
+
+        parallel.mapBands(encodeBand, 0, channels.size, self.jobs)
+        self.newData = pixels
+
+    # values first to last of the message (bytes, as an array) at depth bits per value
+    # i.e. its bits from depth * first to depth * last, padded with 0s at the end of the message,
+    # grouped depth at a time, and multiplied by powers of 2
+    def getValues(self, message, first, last):
+        start, end = self.depth * first, self.depth * last
+        bits = np.unpackbits(message[start // SteganographyCode.NBITS:math.ceil(end / SteganographyCode.NBITS)])
+        bits = bits[start % SteganographyCode.NBITS:start % SteganographyCode.NBITS + end - start]
+        bits = np.pad(bits, (0, end - start - bits.size))
+        powers = (1 << np.arange(self.depth - 1, -1, -1)).astype(np.uint8)
+        return (bits.reshape(-1, self.depth) @ powers).astype(np.uint8)
+
+    # the encoded image as a PIL Image
+    def toImage(self):
         if not hasattr(self, 'newData'):
             self.encode()
 
-        image = Image.new('RGB', self.image.size)
-        image.putdata(self.newData)
-
-        OUTPUT = 'steg_'+self.args.INPUT
-
-        image.save(OUTPUT)
-
-        print('{} created'.format(bold(OUTPUT))) 
-        print('Decode {} with : {}'.format(
-            bold(OUTPUT),
-            colorize('python steganography.py --inputimage {} --decode'.format(OUTPUT), 'pink')
-        ))
-
-    # if DECODE is true,
-    # don't input a message or use it
-    def decode(self):
-
-        print('Attempting to decode {}:'.format(bold(self.args.INPUT)))
-        print()
-
-        data = list(self.image.getdata())
-        bits = []
-
-        # loop over every channel in every triplet
-        # add 0 if % 2 is 0 otherwise 1
-        for triplet in data:
-            for channel in triplet:
-                bits.append(0 if channel%2==0 else 1)
-
-        # chunk the bits together in groups of 8
-        # stringify each bit in the slice, join them, and add a 0b
-        # interpret the string as an integer in base 2 and convert to character
-        # strip 0s from the end
-        message = ''
-        for i in range(0, len(bits), SteganographyCode.NBITS):
-            binStr = '0b' + ''.join([str(n) for n in bits[i:i+SteganographyCode.NBITS]])
-            message += chr(int(binStr, 2))
-
-        return message.strip(chr(0))
-
+        if np is not None and isinstance(self.newData, np.ndarray):
+            with profiling.stage('fromarray'):
+                return Image.fromarray(self.newData)
+
+        with profiling.stage('frombytes'):
+            return Image.frombytes('RGB', self.image.size, self.newData)
+
+    # write to a new image file, in the format given by the extension (see imagefile.py)
+    # compressLevel and optimize control PNG compression
+    def write(self, fileName, compressLevel=None, optimize=False):
+        image = self.toImage()
+        with profiling.stage('save'):
+            imagefile.saveImage(image, fileName, compressLevel, optimize)
+
+    # decode the message in the image
+    # decode just the header first: if there is one, it says how long the message is, the depth,
+    # and the codec; a compressed message is decompressed as it is decoded, a strip at a time
+    # otherwise, the message ends at the first NULL character
+    # either way, stop after length characters if given
+    @profiling.profiled
+    def decode(self, length=None):
+        header = self.decodeRaw(SteganographyCode.HEADER.size).encode('latin-1')
+        if len(header) < SteganographyCode.HEADER.size or not header.startswith(SteganographyCode.MAGIC):
+            return self.decodeRaw(length)
+
+        magic, version, flags, size = SteganographyCode.HEADER.unpack(header)
+        if version > SteganographyCode.VERSION:
+            raise Exception('Image was encoded with a newer version (header version {})'.format(version))
+
+        self.depth = (flags & SteganographyCode.DEPTHMASK) + 1
+        codec = compression.codecName((flags & SteganographyCode.CODECMASK) >> SteganographyCode.CODECSHIFT)
+        if codec is not None:
+            chunks = self.iterRaw(size, self.depth, SteganographyCode.HEADERBITS)
+            with profiling.stage('decompress', codec=codec):
+                return SteganographyCode.decodeUTF8(compression.iterDecompress(chunks, codec), length)
+
+        if length is None or length > size:
+            length = size
+        return self.decodeRaw(length, self.depth, SteganographyCode.HEADERBITS)
+
+    # decode chunks of UTF-8 bytes as they come, stopping as soon as there are length characters, if given
+    # so that a compressed message is only decompressed as far as it is needed
+    # static function (doesn't take self)
+    def decodeUTF8(chunks, length=None):
+        utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        pieces, nChars = [], 0
+        for data in chunks:
+            pieces.append(utf8.decode(data))
+            nChars += len(pieces[-1])
+            if length is not None and nChars >= length:
+                return ''.join(pieces)[:length]
+        pieces.append(utf8.decode(b'', final=True))
+        return ''.join(pieces)[:length]
+
+    # decodeRaw, but yielding the message as bytes, a strip at a time with NumPy
+    def iterRaw(self, length=None, depth=1, start=0):
+        if np is not None and self.image.mode in ('RGB', 'RGBA'):
+            yield from self.iterNumpy(length, depth, start)
+        else:
+            yield self.decodeRaw(length, depth, start).encode('latin-1')
+
+    # decode the characters in the image, with no header
+    # reading depth bits per channel, starting at channel start
+    # they end at the first NULL character, or after length characters if given
+    @profiling.profiled
+    def decodeRaw(self, length=None, depth=1, start=0):
+
+        if np is not None and self.image.mode in ('RGB', 'RGBA'):
+            return self.decodeNumpy(length, depth, start)
+
+        # only the channels that can hold the message are read, a strip of rows at a time
+        nChan = len(self.image.getbands())
+        end = self.image.size[0] * self.image.size[1] * nChan
+        if length is not None:
+            end = min(end, start + math.ceil(length * SteganographyCode.NBITS / depth))
+        rowSize = self.image.size[0] * nChan
+
+        with profiling.stage('assemble'):
+            # the lowest depth bits of each channel, most significant first, as a string of 0s and 1s
+            # chunk the bits together in groups of 8 and interpret each as an integer in base 2
+            # leftover bits that don't make a whole character carry over to the next strip
+            # stop at the first 0, or once there are enough characters
+            table = ['{:0{}b}'.format(channel & ((1 << depth) - 1), depth) for channel in range(256)]
+            codes, bits = bytearray(), ''
+            nRows = max(SteganographyCode.STRIPSIZE // rowSize, 1)
+            for top in range(start // rowSize, math.ceil(end / rowSize), nRows):
+                strip = self.image.crop((0, top, self.image.size[0], min(top + nRows, self.image.size[1]))).tobytes()
+                first = max(start - top*rowSize, 0)
+                bits += ''.join(map(table.__getitem__, strip[first:end - top*rowSize]))
+                nCodes = len(bits) // SteganographyCode.NBITS
+                new = bytes(int(bits[idx:idx+SteganographyCode.NBITS], 2) for idx in range(0, nCodes * SteganographyCode.NBITS, SteganographyCode.NBITS))
+                bits = bits[nCodes * SteganographyCode.NBITS:]
+                if length is None and 0 in new:
+                    codes += new[:new.index(0)]
+                    break
+                codes += new
+                if length is not None and len(codes) >= length:
+                    codes = codes[:length]
+                    break
+
+        return codes.decode('latin-1')
+
+    # vectorized version of decode
+    # instead of getting all the data at once, crop the image into strips of rows
+    # so that only the rows that hold the message are ever converted (skipping any before start)
+    # within a strip, & 1 gets the LSBs and packbits turns them back into bytes
+    # (for more than 1 bit per channel, unpackbits splits every channel into bits, and the lowest depth are kept)
+    # the leftover bits of a strip that don't make a whole byte carry over to the next one
+    # stop as soon as a 0 byte shows up, or once there are enough bytes
+    def decodeNumpy(self, length=None, depth=1, start=0):
+        return b''.join(self.iterNumpy(length, depth, start)).decode('latin-1')
+
+    # the bytes of each strip for decodeNumpy
+    # with more than 1 job and a known length, all of the bytes at once from decodeBands instead
+    def iterNumpy(self, length=None, depth=1, start=0):
+        if length is not None and parallel.getJobs(self.jobs) > 1:
+            yield self.decodeBands(length, depth, start)
+            return
+
+        width, height = self.image.size
+        nChan = len(self.image.getbands())
+        rowsPerStrip = max(1, SteganographyCode.STRIPSIZE // (width * nChan))
+        firstRow = start // (width * nChan)
+        start -= firstRow * width * nChan
+
+        found = 0
+        leftover = np.zeros(0, dtype=np.uint8)
+        for top in range(firstRow, height, rowsPerStrip):
+            strip = np.asarray(self.image.crop((0, top, width, min(top+rowsPerStrip, height)))).reshape(-1)
+            strip, start = strip[start:], 0
+            if depth == 1:
+                bits = strip & 1
+            else:
+                bits = np.unpackbits(strip[:, np.newaxis], axis=1)[:, SteganographyCode.NBITS-depth:].reshape(-1)
+            bits = np.concatenate((leftover, bits))
+
+            nBytes = bits.size // SteganographyCode.NBITS
+            leftover = bits[nBytes * SteganographyCode.NBITS:]
+            chunk = np.packbits(bits[:nBytes * SteganographyCode.NBITS]).tobytes()
+
+            if length is not None:
+                chunk = chunk[:length - found]
+                found += len(chunk)
+                yield chunk
+                if found == length:
+                    return
+            else:
+                end = chunk.find(b'\x00')
+                if end != -1:
+                    yield chunk[:end]
+                    return
+                yield chunk
+
+
+    # decodeNumpy for a known length, in bands of channels, in jobs threads (see parallel.py)
+    # every band starts a multiple of 8 channels after start, so that its bits make whole bytes,
+    # and only crops out the rows holding its channels
+    # as in decodeNumpy, a message running past the end of the image ends at the last whole byte
+    def decodeBands(self, length, depth=1, start=0):
+        width, height = self.image.size
+        rowLength = width * len(self.image.getbands())
+        end = min(start + math.ceil(length * SteganographyCode.NBITS / depth), height * rowLength)
+
+        def decodeBand(first, last):
+            top, bottom = first // rowLength, math.ceil(last / rowLength)
+            strip = np.asarray(self.image.crop((0, top, width, bottom))).reshape(-1)[first - top*rowLength:last - top*rowLength]
+            if depth == 1:
+                bits = strip & 1
+            else:
+                bits = np.unpackbits(strip[:, np.newaxis], axis=1)[:, SteganographyCode.NBITS-depth:].reshape(-1)
+            return np.packbits(bits).tobytes()
+
+        data = b''.join(parallel.mapBands(decodeBand, start, end, self.jobs, SteganographyCode.NBITS))
+        return data[:min(length, (end - start) * depth // SteganographyCode.NBITS)]
+
+
+###########################
+#### LIBRARY FUNCTIONS ####
+###########################
+
+# encode a message (str, or Latin-1 bytes) into the LSBs of a PIL Image (or array)
+# optionally compressing it with one of compression.CODECS
+# and return the new PIL Image
+def embed(image, message, header=True, depth=1, compress=None, jobs=1):
+    return SteganographyCode(image, message, header, depth, compress, jobs).toImage()
+
+# decode the message in the LSBs of a PIL Image (or array)
+def extract(image, length=None, jobs=1):
+    return SteganographyCode(image, jobs=jobs).decode(length)
+
+##################
+#### SHARDING ####
+##################
+
+# a payload (bytes) too large for one image can be split into shards across several images
+# every shard starts with a header: magic, shard index, total number of shards,
+# length of the shard data, and CRC32 of the shard data
+SHARDMAGIC  = b'SHRD'
+SHARDHEADER = struct.Struct('>4sHHII')
+
+# number of payload bytes an image file can hold as a shard
+# only the size in the header of the image is read, so the pixels are never decoded
+def shardCapacity(fileName, depth=1):
+    return max(SteganographyCode.sizeCapacity(imagefile.sizeFile(fileName), depth) - SHARDHEADER.size, 0)
+
+# split a payload into shards, given the capacity of each image, in order
+# images are filled in order, and images that aren't needed get no shard
+# returns the list of shards, each with its header
+def shard(payload, capacities):
+    if sum(capacities) < len(payload):
+        raise Exception('Images are not big enough to hold the whole message')
+
+    pieces = []
+    start = 0
+    for capacity in capacities:
+        if start >= len(payload) and pieces:
+            break
+        pieces.append(payload[start:start+capacity])
+        start += capacity
+
+    return [
+        SHARDHEADER.pack(SHARDMAGIC, index, len(pieces), len(piece), zlib.crc32(piece)) + piece
+        for index, piece in enumerate(pieces)
+    ]
+
+# parse a shard header, returning index, total, length, checksum
+def readShardHeader(header):
+    magic, index, total, length, checksum = SHARDHEADER.unpack(header)
+    if magic != SHARDMAGIC:
+        raise Exception('Image does not contain a shard')
+    return index, total, length, checksum
+
+# check the data of a shard against its header, returning index, total
+def checkShard(header, data):
+    index, total, length, checksum = readShardHeader(header)
+    if len(data) != length or zlib.crc32(data) != checksum:
+        raise Exception('Shard {} is corrupted'.format(index))
+    return index, total
+
+# put shards back together into the payload, whatever order they are in
+# shards is a list of (header, data) pairs
+def unshard(shards):
+    pieces = {}
+    total = None
+    for header, data in shards:
+        index, total = checkShard(header, data)
+        pieces[index] = data
+
+    if total is None or sorted(pieces) != list(range(total)):
+        raise Exception('Missing shards: have {} of {}'.format(sorted(pieces), total))
+
+    return b''.join(pieces[index] for index in range(total))
+
+# embed one shard in one image file and write it out
+# top level function so that it can be sent to worker processes
+def embedShard(inputFile, outputFile, data, depth=1):
+    with imagefile.openImage(inputFile) as image:
+        SteganographyCode(image, data, depth=depth).write(outputFile)
+    return outputFile
+
+# read the shard in an image, as (header, data)
+# read just the header first, then just as many bytes as the header says
+def readShard(image, jobs=1):
+    coder = SteganographyCode(image, jobs=jobs)
+    header = coder.decode(SHARDHEADER.size).encode('latin-1')
+    index, total, length, checksum = readShardHeader(header)
+    data = coder.decode(SHARDHEADER.size + length).encode('latin-1')[SHARDHEADER.size:]
+    return header, data
+
+# read the shard in one image file
+def extractShard(fileName):
+    with imagefile.openImage(fileName, mapped=True) as image:
+        return readShard(image)
+
+# split a payload across image files and embed the shards in parallel
+# returns the list of output files that were written
+def embedShards(payload, inputFiles, outputFiles, workers=None, depth=1):
+    shards = shard(payload, [shardCapacity(fileName, depth) for fileName in inputFiles])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(embedShard, inputFiles, outputFiles, shards, [depth] * len(shards)))
+
+# read the shards in image files, in any order, in parallel, and put the payload back together
+def extractShards(fileNames, workers=None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return unshard(pool.map(extractShard, fileNames))
+
+#####################
+#### MULTI-FRAME ####
+#####################
+
+# a multi-frame cover (an APNG or a multi-page TIFF, see imagefile.FrameReader) can hold a payload
+# too large for any one of its frames: the payload is split into shards across the frames in order,
+# as across image files, and frames are read, embedded, and written one at a time,
+# so only one frame is ever in memory; frames that aren't needed are written as they are
+
+# embed a payload (bytes) across the frames of inputFile, and write them all to outputFile
+# (an APNG or a TIFF, see imagefile.getFrameWriter); every frame has to be the same size
+# return the number of frames holding a shard
+def embedFrames(payload, inputFile, outputFile, depth=1, compressLevel=None, jobs=1):
+    with imagefile.FrameReader(inputFile) as reader:
+        sizes = [reader.getSize(index) for index in range(len(reader))]
+        shards = shard(payload, [max(SteganographyCode.sizeCapacity(size, depth) - SHARDHEADER.size, 0) for size in sizes])
+        with imagefile.getFrameWriter(outputFile, *sizes[0], len(reader), compressLevel) as writer:
+            for index in range(len(reader)):
+                frame = reader.getFrame(index)
+                if index < len(shards):
+                    frame = SteganographyCode(frame, shards[index], depth=depth, jobs=jobs).toImage()
+                with profiling.stage('save'):
+                    writer.writeFrame(frame)
+    return len(shards)
+
+# read the shards in the frames of an image file in order, one frame at a time, and put the payload back together
+# frames after the last shard are never read; with index, return only the data of the shard in that frame
+def extractFrames(fileName, index=None, jobs=1):
+    with imagefile.FrameReader(fileName) as reader:
+        if index is not None:
+            header, data = readShard(reader.getFrame(index), jobs)
+            checkShard(header, data)
+            return data
+
+        shards = []
+        for idx in range(len(reader)):
+            header, data = readShard(reader.getFrame(idx), jobs)
+            shards.append((header, data))
+            if len(shards) == readShardHeader(header)[1]:
+                break
+    return unshard(shards)
 
 ###############################
 #### MAIN ARGPARSE AND RUN ####
 ###############################
 
-parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
-parser.add_argument('-i' , '--inputimage', dest='INPUT'  , default=None       ,                    help='input image'                      )
-parser.add_argument('-m' , '--message'   , dest='MESSAGE', default='-'        ,                    help='input message'                    )
-parser.add_argument('-d' , '--decode'    , dest='DECODE' , action='store_true',                    help='whether to decode an image file'  )
-args = parser.parse_args()
+# read the message from the input file or from stdin
+def readMessage(fileName):
+    if fileName == '-':
+        message = input('{}: {}'.format(bold('Enter message here'), colorize('', 'blue', False)))
+        print('\033[m', end='')
+        return message
+
+    try:
+        with profiling.stage('read'):
+            message = open(fileName).read()
+    except:
+        raise Exception('Error reading from {}'.format(fileName))
+    print('Reading text from {}'.format(bold(fileName)))
+    return message
+
+# the default output image: the input image with a steg_ prefix on its name, in the same directory
+def outputName(fileName):
+    directory, base = os.path.split(fileName)
+    return os.path.join(directory, 'steg_' + base)
+
+# open an image file, memory mapping it if it is uncompressed and only being decoded
+def readImage(fileName, mapped=False):
+    if fileName is None:
+        raise Exception('No image file specified')
+    try:
+        with profiling.stage('open'):
+            image = imagefile.openImage(fileName, mapped)
+    except:
+        raise Exception('Error when trying to open image file {}'.format(bold(fileName)))
+    print('Opening {}'.format(bold(fileName)))
+    return image
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=45))
+    parser.add_argument('-i' , '--inputimage', dest='INPUT'  , default=None       ,                    help='input image'                      )
+    parser.add_argument('-o' , '--outputimage', dest='OUTPUT', default=None       ,                    help='output image (default: steg_ + input image)')
+    parser.add_argument('-m' , '--message'   , dest='MESSAGE', default='-'        ,                    help='input message'                    )
+    parser.add_argument('-d' , '--decode'    , dest='DECODE' , action='store_true',                    help='whether to decode an image file'  )
+    parser.add_argument('-l' , '--length'    , dest='LENGTH' , default=None       ,          type=int, help='number of characters to decode'   )
+    parser.add_argument('-s' , '--shard'     , dest='SHARD'  , default=None       , nargs='+',         help='images to split the message across' )
+    parser.add_argument('-j' , '--jobs'      , dest='JOBS'   , default=None       ,          type=int, help='number of worker processes with --shard, otherwise threads (0 for all CPUs)')
+    parser.add_argument(       '--frame'     , dest='FRAME'  , default=None       ,          type=int, help='frame to decode'                  )
+    parser.add_argument(       '--noheader'  , dest='HEADER' , action='store_false',                   help='whether to leave out the header'  )
+    parser.add_argument('-k' , '--depth'     , dest='DEPTH'  , default=1          ,          type=int, help='number of bits per channel, 1 to 4', choices=range(1, SteganographyCode.MAXDEPTH+1))
+    parser.add_argument(       '--compress'  , dest='COMPRESS', default=None      , choices=compression.CODECS, help='codec to compress the message with')
+    parser.add_argument(       '--level'     , dest='LEVEL'  , default=None       , type=int, choices=range(10), help='PNG compression level, 0 to 9'  )
+    parser.add_argument(       '--optimize'  , dest='OPTIMIZE', action='store_true',                   help='whether to make the PNG as small as possible')
+    parser.add_argument(       '--profile'   , dest='PROFILE', default=None       , nargs='?', const='table', choices=profiling.FORMATS, help='print the time and memory of each stage')
+    args = parser.parse_args(argv)
+
+    if args.SHARD is not None and args.COMPRESS is not None:
+        raise Exception('Compression is not supported with --shard')
+
+    with profiling.profile(args.PROFILE):
+        if args.SHARD is not None:
+            shardMain(args)
+        elif args.DECODE:
+            decodeMain(args)
+        else:
+            encodeMain(args)
+
+# for a single image, --jobs is the number of threads, and by default there is just 1
+def getThreads(args):
+    return 1 if args.JOBS is None else args.JOBS
+
+# decode mode: print the message in the image
+# images with several frames (or with --frame) are decoded as in multi-frame mode (see frameMain)
+def decodeMain(args):
+    if args.FRAME is not None or (args.INPUT is not None and imagefile.hasFrames(args.INPUT)):
+        frameMain(args)
+        return
+    image = readImage(args.INPUT, mapped=True)
+    print('Attempting to decode {}:'.format(bold(args.INPUT)))
+    print()
+    print(colorize(SteganographyCode(image, jobs=getThreads(args)).decode(args.LENGTH), 'blue'))
+
+# encode mode: encode the message into the image and write it to a new file
+# images with several frames are encoded as in multi-frame mode (see frameMain)
+def encodeMain(args):
+    if args.INPUT is not None and imagefile.hasFrames(args.INPUT):
+        frameMain(args)
+        return
+    image = readImage(args.INPUT)
+    message = readMessage(args.MESSAGE) if args.COMPRESS is None else readPayload(args.MESSAGE)
+    coder = SteganographyCode(image, message, args.HEADER, args.DEPTH, args.COMPRESS, getThreads(args))
+
+    print('Image can hold {} characters, message has {}{}: '.format(
+        bold(coder.capacity()),
+        bold(len(coder.message)),
+        '' if args.COMPRESS is None else ' ({} compressed)'.format(bold(coder.size)),
+    ), end='')
+    if coder.size > coder.capacity():
+        print(colorize('Message too large', 'red'))
+        raise Exception('Image is not big enough to hold the whole message')
+    else:
+        print(colorize('OK', 'green'))
+
+    OUTPUT = args.OUTPUT if args.OUTPUT is not None else outputName(args.INPUT)
+
+    coder.write(OUTPUT, args.LEVEL, args.OPTIMIZE)
+
+    print('{} created'.format(bold(OUTPUT)))
+    print('Decode {} with : {}'.format(
+        bold(OUTPUT),
+        colorize('python steganography.py --inputimage {} --decode'.format(OUTPUT), 'pink')
+    ))
+
+# read the message as bytes, from the input file or from stdin (as UTF-8), for compression,
+# sharding, and multi-frame mode
+def readPayload(fileName):
+    if fileName == '-':
+        return readMessage(fileName).encode('utf-8')
+    try:
+        with profiling.stage('read'):
+            payload = open(fileName, 'rb').read()
+    except:
+        raise Exception('Error reading from {}'.format(fileName))
+    print('Reading text from {}'.format(bold(fileName)))
+    return payload
+
+# multi-frame mode: the message is split across the frames of the input image, read as bytes
+# and printed as UTF-8 when decoding, as in sharding mode
+def frameMain(args):
+    if args.INPUT is None:
+        raise Exception('No image file specified')
+    if args.DECODE:
+        print('Attempting to decode {}{}:'.format(bold(args.INPUT), '' if args.FRAME is None else ', frame {}'.format(args.FRAME)))
+        print()
+        try:
+            payload = extractFrames(args.INPUT, args.FRAME, getThreads(args))
+        except OSError:
+            raise Exception('Error when trying to open image file {}'.format(bold(args.INPUT)))
+        print(colorize(payload[:args.LENGTH].decode('utf-8', errors='replace'), 'blue'))
+        return
+
+    if args.COMPRESS is not None or not args.HEADER:
+        raise Exception('Images with several frames cannot be used with --compress or --noheader')
+    payload = readPayload(args.MESSAGE)
+    OUTPUT = args.OUTPUT if args.OUTPUT is not None else outputName(args.INPUT)
+    nShards = embedFrames(payload, args.INPUT, OUTPUT, args.DEPTH, args.LEVEL, getThreads(args))
+
+    print('{} created, with the message across {} frames'.format(bold(OUTPUT), bold(nShards)))
+    print('Decode {} with : {}'.format(
+        bold(OUTPUT),
+        colorize('python steganography.py --inputimage {} --decode'.format(OUTPUT), 'pink')
+    ))
+
+# sharding mode: the message is read as bytes (UTF-8 for standard input)
+# and printed as UTF-8 when decoding
+def shardMain(args):
+    if args.DECODE:
+        print('Attempting to decode {}:'.format(', '.join(bold(fileName) for fileName in args.SHARD)))
+        print()
+        payload = extractShards(args.SHARD, args.JOBS)
+        print(colorize(payload.decode('utf-8', errors='replace'), 'blue'))
+        return
 
-coder = SteganographyCode(args)
+    payload = readPayload(args.MESSAGE)
+    outputFiles = [outputName(fileName) for fileName in args.SHARD]
+    written = embedShards(payload, args.SHARD, outputFiles, args.JOBS, args.DEPTH)
 
-if not args.DECODE:
-    coder.write()
+    print('{} created'.format(', '.join(bold(fileName) for fileName in written)))
+    print('Decode with : {}'.format(
+        colorize('python steganography.py --decode --shard {}'.format(' '.join(written)), 'pink')
+    ))
 
-else:
-    print(colorize(coder.decode(), 'blue'))
+if __name__ == '__main__':
+    main()